@@ -14,8 +14,12 @@ http://creativecommons.org/licenses/by-nc-sa/4.0/.
 import scipy as sp
 import matplotlib.pyplot as plt
 import json
-import argh
 import os
+import time
+import multiprocessing
+from frame_tables import save_table, table_exists
+from centroid_cache import load_centroid_x
+from cli import dispatch
 
 
 class classify_ROIs(object):
@@ -48,6 +52,10 @@ class classify_ROIs(object):
 		self.num_slots = num_slots
 		self.pos_arr = sp.zeros((3, self.num_slots))
 		
+		# Kept for parameter sweeps
+		self.mm_per_px = mm_per_px
+		self.fps = fps
+		
 		# Minimum number of frames to count as a region-to-region transition
 		self.min_ROI_frames = fps*min_ROI_sec
 		
@@ -108,22 +116,36 @@ class classify_ROIs(object):
 			Directory of centroid file. Centroid files are in txt format, one 
 			for each slot. Files are named 'slot_1.avi_x.txt, ..., 
 			slot_N.avi_x.txt'. Each is a 1D list with with N frames, 
-			corresponding to the x-pos of the centroid for that slot.
+			corresponding to the x-pos of the centroid for that slot. If 
+			these are missing, the x-positions are taken from tracks.npy, 
+			written by centroid_tracker.py. Text files are parsed once 
+			and cached, see centroid_cache.
 		
 		"""
 		
-		for iS in range(self.num_slots):
-			filename = os.path.join(in_dir, 'lane_%s.avi_x.txt' % (iS))
-			slot_data = sp.loadtxt(filename)
-			
-			if self.data is None:
-				self.data = sp.zeros((len(slot_data), self.num_slots))
-				self.num_frames = len(slot_data)			
-			self.data[:, iS] = slot_data
+		self.data = load_centroid_x(in_dir, self.num_slots)
+		self.num_frames = self.data.shape[0]
 		
 		self.raw_ROI = sp.empty((self.num_frames, self.num_slots))
 		self.corr_ROI = sp.zeros(self.data.shape)
 		
+	def set_centroid_data(self, data):
+		"""
+		Set the centroid x-coordinates from an array, e.g. the tracks of 
+		the fused pipeline, instead of loading them from file.
+		
+		Parameters
+		----------
+		data : 2D array
+			x-pos of the centroid with shape (frames, num_slots).
+		
+		"""
+		
+		self.data = sp.array(data, dtype=float)
+		self.num_frames = self.data.shape[0]
+		self.raw_ROI = sp.empty((self.num_frames, self.num_slots))
+		self.corr_ROI = sp.zeros(self.data.shape)
+		
 	def ROI_nominal(self):
 		"""
 		Set the ROIs nominally from file, for each slot separately.
@@ -136,7 +158,35 @@ class classify_ROIs(object):
 	
 	def ROI_corrected(self):
 		"""
-		Correct ROI by incorporating minimum transition time
+		Correct ROI by incorporating minimum transition time. ROIs that 
+		last fewer than min_ROI_frames are assigned the ROI of the last 
+		sufficiently long one before them. Computed from the run-length 
+		encoding of each slot; gives the same result as ROI_corrected_loop.
+		"""
+		
+		for iS in range(self.num_slots):
+			
+			# Run-length encoding of the nominal ROIs
+			raw = self.raw_ROI[:, iS]
+			splits = sp.nonzero(sp.diff(raw))[0]
+			run_begs = sp.hstack(([0], splits + 1))
+			run_lens = sp.diff(sp.hstack((run_begs, len(raw))))
+			
+			# First and last run are never changed; the others need to be 
+			# long enough to count as a transition
+			long_runs = run_lens >= self.min_ROI_frames
+			long_runs[0] = True
+			long_runs[-1] = True
+			
+			# Each run takes the ROI of the last long run up to itself
+			last_long = sp.where(long_runs, sp.arange(len(run_lens)), 0)
+			last_long = sp.maximum.accumulate(last_long)
+			self.corr_ROI[:, iS] = sp.repeat(raw[run_begs[last_long]], run_lens)
+	
+	def ROI_corrected_loop(self):
+		"""
+		Correct ROI by incorporating minimum transition time. Reference 
+		implementation of ROI_corrected that walks back over the splits.
 		"""
 		
 		for iS in range(self.num_slots):
@@ -173,30 +223,36 @@ class classify_ROIs(object):
 	
 	def get_ROI_splits(self):
 		"""
-		Get the frames corresponding to a beginning and end of an ROI.
+		Get the frames corresponding to a beginning and end of an ROI. 
+		The segments of all slots are found at once from the run 
+		boundaries of corr_ROI.
 		"""
 		
+		# Run boundaries of each slot, including beginning and end of data
+		bounds = sp.ones((self.num_slots, self.num_frames + 1), dtype=bool)
+		bounds[:, 1:-1] = (sp.diff(self.corr_ROI, axis=0) != 0).T
+		slots, idxs = sp.nonzero(bounds)
+		
+		# Consecutive boundaries of the same slot enclose a segment
+		same_slot = slots[:-1] == slots[1:]
+		idx_beg = idxs[:-1][same_slot]
+		idx_end = idxs[1:][same_slot]
+		slots = slots[:-1][same_slot]
+		
+		# The ROI is read from the second frame of each segment, so 
+		# segments starting at the last frame are dropped
+		keep = idx_beg + 1 < self.num_frames
+		
 		# The columns of ROI_splits are: ROI, beg idx, end idx, slot number
-		self.ROI_splits = sp.zeros(4)
+		self.ROI_splits = sp.empty((4, sp.sum(keep)), dtype=int)
+		self.ROI_splits[0] = self.corr_ROI[idx_beg[keep] + 1, slots[keep]]
+		self.ROI_splits[1] = idx_beg[keep]
+		self.ROI_splits[2] = idx_end[keep]
+		self.ROI_splits[3] = slots[keep]
 		
-		for iS in range(self.num_slots):
-			split_idxs = sp.nonzero(sp.diff(self.corr_ROI[:, iS]))[0]
-			split_idxs = sp.hstack(([-1], split_idxs))
-			if (self.num_frames - 1) not in split_idxs:
-				split_idxs = sp.hstack((split_idxs, self.num_frames - 1))
-			
-			for iI in range(len(split_idxs) - 1):
-				idx_beg = split_idxs[iI] + 1
-				idx_end = split_idxs[iI + 1] + 1
-				if idx_beg+1 >= self.num_frames:
-				    continue
-				arr = [self.corr_ROI[idx_beg + 1, iS], idx_beg, idx_end, iS]
-				self.ROI_splits = sp.vstack((self.ROI_splits.T, arr)).T
-		self.ROI_splits = self.ROI_splits.astype(int)
-		
-	def save_data(self, out_dir):
-		"""
-		Output nominal and corrected data and ROI splits as txt files. The
+	def save_data(self, out_dir, table_format='txt'):
+		"""
+		Output nominal and corrected data and ROI splits as tables. The
 		ROI_splits file is saved by row, where each row corresponnds to 
 		a given snippet of the video in which the fly is in a unique ROI.
 		The first column is the ROI (from {0, 6} as defined above), second 
@@ -207,31 +263,398 @@ class classify_ROIs(object):
 		----------
 		out_dir : str
 			Directory of where to save data.
+		table_format : str
+			'txt', 'npy' (int8 tables), or 'both'; see frame_tables.
 		
 		"""
 		
-		nominal_output_path =  os.path.join(out_dir, 'nominal_ROIs.txt')
-		corr_output_path =  os.path.join(out_dir, 'corrected_ROIs.txt')
-		ROI_splits_path = os.path.join(out_dir, 'ROI_frame_splits.txt')
-		with open(nominal_output_path, 'w') as fp:
-			sp.savetxt(fp, self.raw_ROI, fmt='%d', delimiter='\t')
-		with open(corr_output_path, 'w') as fp:
-			sp.savetxt(fp, self.corr_ROI, fmt='%d', delimiter='\t')
-		with open(ROI_splits_path, 'w') as fp:
-			sp.savetxt(fp, self.ROI_splits.T, fmt='%d', delimiter='\t')
+		save_table(out_dir, 'nominal_ROIs', self.raw_ROI, table_format)
+		save_table(out_dir, 'corrected_ROIs', self.corr_ROI, table_format)
+		save_table(out_dir, 'ROI_frame_splits', self.ROI_splits.T, table_format)
 		
+	def sweep(self, ROI_widths, min_ROI_secs, mm_per_pxs=None):
+		"""
+		Classify the loaded centroid data for every combination of the 
+		given parameters at once. The bin edges of all parameter sets are 
+		broadcast against the data, and the minimum dwell correction and 
+		segmentation run on all parameter sets and slots together. Gives 
+		the same segments as running ROI_nominal, ROI_corrected and 
+		get_ROI_splits for each parameter set.
 		
-def main(in_dir, out_dir, mm_per_px=3./106, ROI_width=3.5, fps=60, 
-			min_ROI_sec=0.25, num_slots=4):
+		Parameters
+		----------
+		ROI_widths : list of floats
+			widths of the ROIs near wall or laser in mm.
+		min_ROI_secs : list of floats
+			minimum dwell times in seconds.
+		mm_per_pxs : list of floats, optional
+			image resolutions in mm per pixel; defaults to mm_per_px of 
+			this object.
+		
+		Returns
+		-------
+		params : 2D array
+			Parameter sets with shape (sets, 3); columns are mm_per_px, 
+			ROI_width, and min_ROI_sec.
+		ROI_splits : list of 2D arrays
+			Segments of each parameter set as in ROI_frame_splits.txt; 
+			columns are ROI, beg idx, end idx, and slot number.
+		
+		"""
+		
+		if mm_per_pxs is None:
+			mm_per_pxs = [self.mm_per_px]
+		params = sp.array([[mm_per_px, ROI_width, min_ROI_sec] 
+							for mm_per_px in mm_per_pxs 
+							for ROI_width in ROI_widths 
+							for min_ROI_sec in min_ROI_secs], dtype=float)
+		num_params = len(params)
+		num_frames, num_slots = self.num_frames, self.num_slots
+		
+		# Nominal ROIs only depend on the ROI width in pixels
+		widths_px, width_idxs = sp.unique(params[:, 1]/params[:, 0], 
+											return_inverse=True)
+		offsets = sp.array([0, 1, -1, 0, 1, -1, 0])
+		bins = self.pos_arr[[0, 0, 1, 1, 1, 2, 2]].T[sp.newaxis] + \
+				offsets*widths_px[:, sp.newaxis, sp.newaxis]
+		
+		# Digitize by counting the bin edges below each x-pos; shape is
+		# (widths, slots, frames). As in sp.digitize, nan is above all bins
+		x = self.data.T
+		raw = sp.sum(x[sp.newaxis, :, :, sp.newaxis] >= 
+						bins[:, :, sp.newaxis, :], axis=-1, dtype=sp.int8) - 1
+		raw[:, sp.isnan(x)] = bins.shape[-1] - 1
+		
+		# One row per parameter set and slot
+		raw = raw[width_idxs].reshape(num_params*num_slots, num_frames)
+		min_frames = sp.repeat(self.fps*params[:, 2], num_slots)
+		
+		# Run-length encoding of all rows; every row starts a new run
+		starts = sp.ones(raw.shape, dtype=bool)
+		starts[:, 1:] = raw[:, 1:] != raw[:, :-1]
+		run_rows, run_cols = sp.nonzero(starts)
+		run_begs = sp.flatnonzero(starts)
+		run_lens = sp.diff(sp.hstack((run_begs, raw.size)))
+		
+		# First and last run of each row are always kept, see ROI_corrected
+		first_runs = run_cols == 0
+		last_runs = sp.hstack((first_runs[1:], True))
+		long_runs = (run_lens >= min_frames[run_rows]) | first_runs | last_runs
+		last_long = sp.where(long_runs, sp.arange(len(run_lens)), 0)
+		last_long = sp.maximum.accumulate(last_long)
+		corr = sp.repeat(raw.ravel()[run_begs[last_long]], run_lens)
+		corr = corr.reshape(raw.shape)
+		
+		# Segments of all rows, see get_ROI_splits
+		bounds = sp.ones((raw.shape[0], num_frames + 1), dtype=bool)
+		bounds[:, 1:-1] = corr[:, 1:] != corr[:, :-1]
+		rows, idxs = sp.nonzero(bounds)
+		same_row = rows[:-1] == rows[1:]
+		idx_beg = idxs[:-1][same_row]
+		idx_end = idxs[1:][same_row]
+		rows = rows[:-1][same_row]
+		keep = idx_beg + 1 < num_frames
+		idx_beg, idx_end, rows = idx_beg[keep], idx_end[keep], rows[keep]
+		segments = sp.column_stack((corr[rows, idx_beg + 1], idx_beg, 
+									idx_end, rows % num_slots)).astype(int)
+		
+		# Split the segments by parameter set; rows are sorted
+		splits = sp.searchsorted(rows // num_slots, sp.arange(1, num_params))
+		
+		return params, sp.split(segments, splits)
+		
+	def stream(self):
+		"""
+		Get an online classifier with the ROI bins and minimum dwell time 
+		of this object; call after load_laser_wall_pos.
+		"""
+		
+		return stream_ROIs(self.ROI_bins, self.min_ROI_frames)
+		
+		
+class stream_ROIs(object):
+	"""
+	Online version of ROI_nominal, ROI_corrected and get_ROI_splits for 
+	centroid data that arrives in chunks, e.g. during acquisition. Only 
+	the current run of each slot is kept, so memory does not grow with 
+	the length of the recording. Segments are emitted as soon as they 
+	can no longer change and are the rows of ROI_splits.T that the batch 
+	classification gives for the same data.
+	"""
 	
+	def __init__(self, ROI_bins, min_ROI_frames):
+		"""
+		Initialize class. 
+		
+		Parameters
+		----------
+		ROI_bins : 2D array
+			Bin edges of the ROIs with shape (7, num_slots), see 
+			classify_ROIs.load_laser_wall_pos.
+		min_ROI_frames : float
+			minimum dwell time in frames.
+			
+		"""
+		
+		self.ROI_bins = sp.asarray(ROI_bins)
+		self.num_slots = self.ROI_bins.shape[1]
+		self.min_ROI_frames = min_ROI_frames
+		
+		# Number of frames received, and finalized in each slot
+		self.num_frames = 0
+		self.num_final = sp.zeros(self.num_slots, dtype=int)
+		
+		# Finalized frames in each ROI; column ROI + 1, as ROIs -1 and 6 
+		# are outside the walls
+		self.dwell_frames = sp.zeros((self.num_slots, 
+								self.ROI_bins.shape[0] + 1), dtype=int)
+		
+		# Current run of nominal ROIs, and ROI of the last long run
+		self.run_ROI = [None]*self.num_slots
+		self.run_beg = sp.zeros(self.num_slots, dtype=int)
+		self.long_ROI = [None]*self.num_slots
+		
+		# Current segment of corrected ROIs
+		self.seg_ROI = [None]*self.num_slots
+		self.seg_beg = sp.zeros(self.num_slots, dtype=int)
+		
+		self.segments = []
+		
+	def _finalize(self, iS, ROI, end):
+		"""
+		Set the corrected ROI of the frames up to end.
+		"""
+		
+		beg = self.num_final[iS]
+		if end <= beg:
+			return
+		if self.seg_ROI[iS] is None:
+			self.seg_ROI[iS] = ROI
+		elif ROI != self.seg_ROI[iS]:
+			
+			# As in get_ROI_splits, the ROI of a segment is read from its 
+			# second frame
+			seg_beg = self.seg_beg[iS]
+			seg_ROI = self.seg_ROI[iS] if beg - seg_beg > 1 else ROI
+			self.segments.append([seg_ROI, seg_beg, beg, iS])
+			self.seg_ROI[iS] = ROI
+			self.seg_beg[iS] = beg
+		self.dwell_frames[iS, ROI + 1] += end - beg
+		self.num_final[iS] = end
+		
+	def _end_run(self, iS, end):
+		"""
+		Finalize the current run, which is followed by another ROI at end.
+		"""
+		
+		run_len = end - self.run_beg[iS]
+		if self.run_beg[iS] == 0 or run_len >= self.min_ROI_frames:
+			self.long_ROI[iS] = self.run_ROI[iS]
+		self._finalize(iS, self.long_ROI[iS], end)
+		
+	def update(self, data):
+		"""
+		Add a chunk of centroid data.
+		
+		Parameters
+		----------
+		data : 2D array
+			x-pos of the centroid with shape (frames, num_slots).
+		
+		Returns
+		-------
+		segments : 2D array
+			Finalized segments with shape (segments, 4); columns are ROI, 
+			beg idx, end idx, and slot number as in ROI_frame_splits.txt.
+		
+		"""
+		
+		data = sp.asarray(data, dtype=float).reshape(-1, self.num_slots)
+		for iS in range(self.num_slots):
+			pos = self.num_frames
+			raw = sp.digitize(data[:, iS], self.ROI_bins[:, iS]) - 1
+			
+			# Run-length encoding of the chunk
+			run_begs = sp.hstack(([0], sp.nonzero(sp.diff(raw))[0] + 1))
+			run_lens = sp.diff(sp.hstack((run_begs, len(raw))))
+			for ROI, run_len in zip(raw[run_begs], run_lens):
+				if ROI != self.run_ROI[iS]:
+					if self.run_ROI[iS] is not None:
+						self._end_run(iS, pos)
+					self.run_ROI[iS] = ROI
+					self.run_beg[iS] = pos
+				pos += run_len
+			
+			# A run that is long enough (or the first) keeps its ROI, so 
+			# its frames are final even if it continues
+			run_len = pos - self.run_beg[iS]
+			if self.run_beg[iS] == 0 or run_len >= self.min_ROI_frames:
+				self._finalize(iS, self.run_ROI[iS], pos)
+		self.num_frames += len(data)
+		
+		return self.pop_segments()
+		
+	def close(self):
+		"""
+		End of the recording. The last run always keeps its ROI.
+		
+		Returns
+		-------
+		segments : 2D array
+			Remaining segments, see update.
+		
+		"""
+		
+		for iS in range(self.num_slots):
+			if self.run_ROI[iS] is None:
+				continue
+			self._finalize(iS, self.run_ROI[iS], self.num_frames)
+			
+			# Segments starting at the last frame are dropped
+			seg_beg = self.seg_beg[iS]
+			if seg_beg + 1 < self.num_frames:
+				self.segments.append([self.seg_ROI[iS], seg_beg, 
+										self.num_frames, iS])
+			self.run_ROI[iS] = None
+		
+		return self.pop_segments()
+	
+	def pop_segments(self):
+		"""
+		Return and clear the segments finalized so far.
+		"""
+		
+		segments = sp.array(self.segments, dtype=int).reshape(-1, 4)
+		self.segments = []
+		
+		return segments
+		
+		
+def classify_dir(in_dir, out_dir, mm_per_px=3./106, ROI_width=3.5, fps=60, 
+			min_ROI_sec=0.25, num_slots=4, table_format='txt'):
+	"""
+	Classify the ROIs of one experiment and save the output.
+	
+	Returns
+	-------
+	elapsed : float
+		Processing time in seconds.
+	
+	"""
+	
+	start = time.time()
 	a = classify_ROIs(mm_per_px, ROI_width, fps, min_ROI_sec, num_slots)
 	a.load_laser_wall_pos(in_dir)
 	a.load_centroid_data(in_dir)
 	a.ROI_nominal()
 	a.ROI_corrected()
 	a.get_ROI_splits()
-	a.save_data(out_dir)
+	a.save_data(out_dir, table_format)
+	
+	return time.time() - start
+	
+
+def _classify_dir_task(args):
+	"""
+	Pool worker for batch; returns the directory, time, and error if any.
+	"""
+	
+	in_dir = args[0]
+	try:
+		return in_dir, classify_dir(in_dir, in_dir, *args[1:]), None
+	except Exception as e:
+		return in_dir, 0, repr(e)
+	
+
+def main(in_dir, out_dir, mm_per_px=3./106, ROI_width=3.5, fps=60, 
+			min_ROI_sec=0.25, num_slots=4, table_format='txt'):
+	
+	classify_dir(in_dir, out_dir, mm_per_px, ROI_width, fps, min_ROI_sec, 
+					num_slots, table_format)
+	
+	
+def sweep(in_dir, out_dir, ROI_widths='3.5', min_ROI_secs='0.25', 
+			mm_per_pxs='%s' % (3./106), fps=60, num_slots=4, 
+			table_format='txt'):
+	"""
+	Classify one experiment for every combination of the comma separated 
+	parameter lists. The segments of each parameter set are saved as 
+	ROI_frame_splits_mm_per_px=..._ROI_width=..._min_ROI_sec=....
+	
+	"""
+	
+	start = time.time()
+	mm_per_pxs = [float(val) for val in mm_per_pxs.split(',')]
+	a = classify_ROIs(mm_per_pxs[0], 0, fps, 0, num_slots)
+	a.load_laser_wall_pos(in_dir)
+	a.load_centroid_data(in_dir)
+	params, ROI_splits = a.sweep(
+		[float(val) for val in ROI_widths.split(',')], 
+		[float(val) for val in min_ROI_secs.split(',')], mm_per_pxs)
+	for (mm_per_px, ROI_width, min_ROI_sec), splits in zip(params, ROI_splits):
+		name = 'ROI_frame_splits_mm_per_px=%g_ROI_width=%g_min_ROI_sec=%g' \
+				% (mm_per_px, ROI_width, min_ROI_sec)
+		save_table(out_dir, name, splits, table_format)
+	print ('%d parameter sets in %.2f s' % (len(params), time.time() - start))
+	
+	
+def batch(exp_dir, workers=0, mm_per_px=3./106, ROI_width=3.5, fps=60, 
+			min_ROI_sec=0.25, num_slots=4, table_format='txt'):
+	"""
+	Classify all experiments in exp_dir whose analysis_output has 
+	centroid data but no corrected_ROIs table yet, in a process pool. 
+	Output is saved in each analysis_output directory. Exits with 
+	status 1 if any directory failed.
+	
+	Parameters
+	----------
+	exp_dir : str
+		Directory containing one directory per experiment.
+	workers : int
+		Number of worker processes; 0 uses all cores.
+	table_format : str
+		'txt', 'npy' (int8 tables), or 'both'; see frame_tables.
+	
+	"""
+	
+	dirs_to_analyze = []
+	for dir in sorted(next(os.walk(exp_dir))[1]):
+		full_dir = os.path.join(exp_dir, dir, 'analysis_output')
+		has_centroids = \
+			os.path.exists(os.path.join(full_dir, 'lane_%s.avi_x.txt' 
+										% (num_slots - 1))) or \
+			os.path.exists(os.path.join(full_dir, 'tracks.npy'))
+		done = table_exists(full_dir, 'corrected_ROIs')
+		if has_centroids and not done:
+			dirs_to_analyze.append(full_dir)
+	print ('%d directories to analyze' % len(dirs_to_analyze))
+	if len(dirs_to_analyze) == 0:
+		return
+	
+	if workers == 0:
+		workers = multiprocessing.cpu_count()
+	tasks = [(dir, mm_per_px, ROI_width, fps, min_ROI_sec, num_slots, 
+				table_format) 
+				for dir in dirs_to_analyze]
+	
+	start = time.time()
+	results = []
+	with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+		for result in pool.imap_unordered(_classify_dir_task, tasks):
+			results.append(result)
+			print ('%s: %s' % (result[0], result[2] if result[2] 
+					else '%.2f s' % result[1]))
+	
+	# Timing summary
+	print ('\n%-60s %10s' % ('directory', 'time (s)'))
+	for dir, elapsed, error in sorted(results):
+		print ('%-60s %10s' % (dir, 'failed' if error else '%.2f' % elapsed))
+	num_failed = sum(1 for result in results if result[2])
+	print ('%d directories in %.2f s (%d failed)' 
+			% (len(results), time.time() - start, num_failed))
+	if num_failed > 0:
+		raise SystemExit('%d directories failed' % num_failed)
 	
 	
 if __name__ == '__main__':
-	argh.dispatch_command(main)
\ No newline at end of file
+	dispatch(main, [batch, sweep])
\ No newline at end of file
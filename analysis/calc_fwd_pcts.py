@@ -1,6 +1,9 @@
 """
 Find transition probability across laser or away from laser.
 
+load_table comes from frame_tables in the repository root, which has to 
+be on PYTHONPATH (e.g. PYTHONPATH=.. when running from this directory).
+
 Created by Nirag Kadakia at 17:40 08-20-2018
 This work is licensed under the 
 Creative Commons Attribution-NonCommercial-ShareAlike 4.0 
@@ -14,6 +17,8 @@ import matplotlib.pyplot as plt
 import argh
 import os
 
+from frame_tables import load_table
+
 
 class transitions(object):
 	"""
@@ -71,11 +76,11 @@ class transitions(object):
 		Parameters
 		----------
 		dir : str
-			diretory from which to load `ROI_frame_splits.txt' file.
+			diretory from which to load `ROI_frame_splits' table (.npy 
+			or .txt).
 		"""
 		
-		filename = os.path.join(dir, 'ROI_frame_splits.txt')
-		ROI_data = sp.loadtxt(filename, dtype='int')
+		ROI_data = load_table(dir, 'ROI_frame_splits')
 			
 		for iS in range(self.num_slots):
 			if self.ROI_data is None:
@@ -1,6 +1,9 @@
 """
 Get the number of touches while near wall or while near the laser wall.
 
+box_smooth comes from smoothing in the repository root, which has to be 
+on PYTHONPATH (e.g. PYTHONPATH=.. when running from this directory).
+
 Created by Nirag Kadakia at 18:00 08-21-2018
 This work is licensed under the 
 Creative Commons Attribution-NonCommercial-ShareAlike 4.0 
@@ -16,6 +19,8 @@ import argh
 import os
 from detect_peaks import detect_peaks
 
+from smoothing import box_smooth, box_window
+
 class postures(object):
 	"""
 	Classify fly as being in particular region of interest in the assay.
@@ -179,28 +184,29 @@ class postures(object):
 			else:
 				pass
 		
-	def smooth(self, arr, window_T=1.0):
+	def smooth(self, arr, window_T=1.0, edge_mode='nearest'):
 		"""
 		Smooth a position trace with box average.
 		
 		Parameters
 		----------
 		
-		arr: 1D array
-			array to be smoothed.
+		arr: 1D or 2D array
+			array to be smoothed; columns of a 2D array are smoothed 
+			independently.
 		window_T: float
 			length of box filter in seconds.
+		edge_mode: str
+			handling of the ends of the trace, see smoothing.box_smooth; 
+			the default repeats the first and last sample, 'wrap' gives 
+			the roll-based smoothing used before, which mixes both ends.
 			
 		"""
 		
 		# Box smooth in window of window_T
-		smooth_frames = int(1.*self.fps*window_T)
-		smoothed_data = sp.zeros(len(arr))
-		smoothing_window = sp.arange(-smooth_frames, smooth_frames)
-		for iN in smoothing_window:
-			smoothed_data += sp.roll(arr, iN)
-		smoothed_data = smoothed_data/len(smoothing_window)
-			
+		smoothed_data = box_smooth(arr, box_window(self.fps, window_T), 
+								   mode=edge_mode)
+		
 		return smoothed_data
 
 	def save_touches(self, dir, lane, name):
@@ -259,13 +265,11 @@ class postures(object):
 		mpd = int(peak_sep*self.fps)
 		dw = int(dwall/self.mm_per_px)
 		
-		# Two postures to track (left and right leg); change this in __init__
-		R_leg_tip_x = self.smooth(self.DLC_data[:, 1], window_T=smoothing_dt)
-		L_leg_tip_x = self.smooth(self.DLC_data[:, 22], window_T=smoothing_dt)
-		
-		# Need y's for each posture
-		R_leg_tip_y = self.smooth(self.DLC_data[:, 2], window_T=smoothing_dt)
-		L_leg_tip_y = self.smooth(self.DLC_data[:, 23], window_T=smoothing_dt)
+		# Two postures to track (left and right leg), with x and y for each;
+		# change this in __init__. All columns are smoothed at once.
+		R_leg_tip_x, L_leg_tip_x, R_leg_tip_y, L_leg_tip_y = \
+			self.smooth(self.DLC_data[:, [1, 22, 2, 23]], 
+						window_T=smoothing_dt).T
 		
 		posture_xlist = [R_leg_tip_x, L_leg_tip_x]
 		posture_ylist = [R_leg_tip_y, L_leg_tip_y]
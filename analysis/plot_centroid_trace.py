@@ -1,6 +1,9 @@
 """
 Smooth and plot centroid data and color by acceleration 
 
+load_centroid_x and box_smooth come from the repository root, which has 
+to be on PYTHONPATH (e.g. PYTHONPATH=.. when running from this directory).
+
 Created by Nirag Kadakia at 12:00 08-21-2018
 This work is licensed under the 
 Creative Commons Attribution-NonCommercial-ShareAlike 4.0 
@@ -15,6 +18,9 @@ import json
 import argh
 import os
 
+from centroid_cache import load_centroid_x
+from smoothing import box_smooth, box_window
+
 
 class centroid(object):
 	"""
@@ -111,41 +117,37 @@ class centroid(object):
 			Directory of centroid file. Centroid files are in txt format, one 
 			for each slot. Files are named 'slot_1.avi_x.txt, ..., 
 			slot_N.avi_x.txt'. Each is a 1D list with with N frames, 
-			corresponding to the x-pos of the centroid for that slot.
+			corresponding to the x-pos of the centroid for that slot. 
+			Text files are parsed once and cached, see centroid_cache.
 		
 		"""
 		
-		self.data = None
-		for iS in range(self.num_slots):
-			filename = os.path.join(in_dir, 'lane_%s.avi_x.txt' % (iS))
-			slot_data = sp.loadtxt(filename)
-			if self.data is None:
-				self.data = sp.zeros((len(slot_data), self.num_slots))
-			self.num_frames = len(slot_data)
-			self.Tt = sp.linspace(0, self.num_frames/self.fps, self.num_frames)
-			self.data[:, iS] = slot_data
-		
-	def smooth(self, arr, window_T=1.0):
+		self.data = load_centroid_x(in_dir, self.num_slots)
+		self.num_frames = self.data.shape[0]
+		self.Tt = sp.linspace(0, self.num_frames/self.fps, self.num_frames)
+		
+	def smooth(self, arr, window_T=1.0, edge_mode='nearest'):
 		"""
 		Smooth a position trace with box average.
 		
 		Parameters
 		----------
 		
-		arr: 1D array
-			array to be smoothed.
+		arr: 1D or 2D array
+			array to be smoothed; columns of a 2D array are smoothed 
+			independently.
 		window_T: float
 			length of box filter in seconds.
+		edge_mode: str
+			handling of the ends of the trace, see smoothing.box_smooth; 
+			the default repeats the first and last sample, 'wrap' gives 
+			the roll-based smoothing used before, which mixes both ends.
 			
 		"""
 		
 		# Box smooth in window of window_T
-		smooth_frames = int(1.*self.fps*window_T)
-		smoothed_data = sp.zeros(len(arr))
-		smoothing_window = sp.arange(-smooth_frames, smooth_frames)
-		for iN in smoothing_window:
-			smoothed_data += sp.roll(arr, iN)
-		smoothed_data = smoothed_data/len(smoothing_window)
+		smoothed_data = box_smooth(arr, box_window(self.fps, window_T), 
+								   mode=edge_mode)
 		
 		return smoothed_data
 		
@@ -164,6 +166,8 @@ class centroid(object):
 		base_dir = os.path.dirname(in_dir)
 		exp_dir = os.path.basename(in_dir)
 		
+		smoothed_data = self.smooth(self.data[:, :self.num_slots])
+		
 		for iS in range(self.num_slots):
 			
 			fig = plt.figure()
@@ -173,8 +177,7 @@ class centroid(object):
 			plt.xticks([])
 			plt.yticks([])
 			
-			smoothed_data = self.smooth(self.data[:, iS])
-			plt.scatter(self.Tt, smoothed_data, s=1, color='k')
+			plt.scatter(self.Tt, smoothed_data[:, iS], s=1, color='k')
 			plt.axhline(y = self.pos_arr[1, iS], color='r', lw=2, ls='--')
 			
 			out_dir = os.path.join(base_dir, '_centroid/_tracks', )
@@ -0,0 +1,53 @@
+"""
+Benchmark the run-length ROI_corrected against the loop over splits in 
+ROI_corrected_loop on noisy synthetic ROI traces.
+"""
+
+import scipy as sp
+import argh
+import time
+from ROI_track import classify_ROIs
+
+
+def noisy_ROIs(num_frames, num_slots, mean_run, seed):
+	"""
+	Random ROI traces whose dwell times are geometrically distributed 
+	with mean mean_run frames, so that short flickering ROIs are common.
+	"""
+	
+	sp.random.seed(seed)
+	data = sp.zeros((num_frames, num_slots))
+	for iS in range(num_slots):
+		steps = sp.random.random(num_frames) < 1./mean_run
+		steps = steps*sp.random.randint(1, 6, num_frames)
+		data[:, iS] = sp.cumsum(steps) % 6
+	return data
+
+
+def main(num_frames=216000, num_slots=4, mean_run=4., fps=60, 
+			min_ROI_sec=0.25, seed=0):
+	
+	a = classify_ROIs(3./106, 3.5, fps, min_ROI_sec, num_slots)
+	a.num_frames = num_frames
+	a.raw_ROI = noisy_ROIs(num_frames, num_slots, mean_run, seed)
+	num_splits = sp.count_nonzero(sp.diff(a.raw_ROI, axis=0))
+	
+	a.corr_ROI = a.raw_ROI.copy()
+	start = time.time()
+	a.ROI_corrected()
+	vectorized_time = time.time() - start
+	corr_ROI = a.corr_ROI.copy()
+	
+	a.corr_ROI = a.raw_ROI.copy()
+	start = time.time()
+	a.ROI_corrected_loop()
+	loop_time = time.time() - start
+	
+	assert sp.array_equal(corr_ROI, a.corr_ROI)
+	print ('%d frames, %d transitions: loop %.3f s, vectorized %.4f s, '
+			'speedup %.0fx' % (num_frames*num_slots, num_splits, loop_time, 
+			vectorized_time, loop_time/vectorized_time))
+	
+	
+if __name__ == '__main__':
+	argh.dispatch_command(main)
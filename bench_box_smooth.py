@@ -0,0 +1,42 @@
+#! /anaconda3/bin/python
+
+import time
+import argh
+import numpy as np
+from smoothing import box_smooth, box_smooth_loop
+
+def main(sizes='18000,180000', columns=24, window=8, seed=0):
+    """
+    Benchmark box_smooth on a batch of traces against smoothing each trace
+    with the roll loop, and check that both give the same result.
+
+    Parameters
+    ----------
+    sizes : string
+        Comma separated list of trace lengths (frames).
+    columns : int, default=24
+        Number of traces, e.g. the x and y columns of the DLC body parts.
+    window : int, default=8
+        Window length in frames; 0.15 s at 25 fps is 2*3 frames.
+    seed : int, default=0
+        Seed of the random number generator.
+    """
+    rng = np.random.RandomState(seed)
+    for size in [int(s) for s in sizes.split(',')]:
+        traces = np.cumsum(rng.randn(size, columns), axis=0) + 400
+
+        start = time.time()
+        result = box_smooth(traces, window)
+        cumsum_time = time.time() - start
+
+        start = time.time()
+        expected = np.stack([box_smooth_loop(traces[:, iC], window)
+                             for iC in range(columns)], axis=1)
+        loop_time = time.time() - start
+
+        assert np.allclose(result, expected, rtol=0, atol=1e-8)
+        print(f'{size} x {columns} samples: loop {loop_time:.3f} s, cumsum {cumsum_time:.4f} s, '
+              f'speedup {loop_time / cumsum_time:.1f}x')
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
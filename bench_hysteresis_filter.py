@@ -0,0 +1,43 @@
+#! /anaconda3/bin/python
+
+import time
+import argh
+import numpy as np
+from step_1 import hysteresis_filter, hysteresis_filter_loop
+
+def main(sizes='1000000,10000000', n=50, n_false=1, flip_prob=0.05, seed=0):
+    """
+    Benchmark the run-length hysteresis_filter against the element-wise loop
+    on random boolean sequences and check that both give the same result.
+
+    Parameters
+    ----------
+    sizes : string
+        Comma separated list of sequence lengths.
+    n : int, default=50
+        Length of hysteresis memory.
+    n_false : int, default=1
+        Length of hysteresis memory for the false state.
+    flip_prob : float, default=0.05
+        Probability that an element differs from the previous one.
+    seed : int, default=0
+        Seed of the random number generator.
+    """
+    rng = np.random.RandomState(seed)
+    for size in [int(s) for s in sizes.split(',')]:
+        seq = np.logical_xor.accumulate(rng.rand(size) < flip_prob)
+
+        start = time.time()
+        result = hysteresis_filter(seq, n, n_false)
+        vectorized_time = time.time() - start
+
+        start = time.time()
+        expected = hysteresis_filter_loop(seq, n, n_false)
+        loop_time = time.time() - start
+
+        assert np.array_equal(result, expected)
+        print(f'{size} elements: loop {loop_time:.3f} s, vectorized {vectorized_time:.4f} s, '
+              f'speedup {loop_time / vectorized_time:.0f}x')
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,115 @@
+#! /anaconda3/bin/python
+
+import os
+import os.path
+import glob
+import argh
+import numpy as np
+from centroid_tracker import fill_tracks
+
+def cache_path(path):
+    """
+    Path of the binary sidecar of a text export. The size and modification
+    time of the export are part of the name, so a changed export never
+    matches an old cache.
+    """
+    stat = os.stat(path)
+    return f'{path}.{stat.st_size}_{stat.st_mtime_ns}.cache.npy'
+
+def parse_export(path):
+    """
+    Parse a TPro text export (comma or white space separated) into a 2D
+    float array with one row per frame.
+    """
+    with open(path, 'r') as fp:
+        delimiter = ',' if ',' in fp.readline() else None
+    return np.loadtxt(path, delimiter=delimiter, ndmin=2)
+
+def load_export(path, mmap_mode='r'):
+    """
+    Load a text export through its binary sidecar. The export is parsed once
+    and saved as path.<size>_<mtime>.cache.npy; later calls memory-map the
+    sidecar. Stale sidecars of the export are removed. If the directory is
+    not writable, the export is parsed every time.
+
+    Parameters
+    ----------
+    path : string
+        Path of the export, e.g. lane_0.avi_x.txt.
+    mmap_mode : {'r', None}, default='r'
+        Memory-map the cache or read it into memory.
+
+    Returns
+    -------
+    2D np.array of type float64
+        Export with shape (frames, columns).
+    """
+    cache = cache_path(path)
+    if os.path.exists(cache):
+        return np.load(cache, mmap_mode=mmap_mode)
+    data = parse_export(path)
+    for stale in glob.glob(glob.escape(path) + '.*.cache.npy'):
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+    # write to a temporary file first, batch workers may load the same export
+    tmp = f'{cache}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as fp:
+            np.save(fp, data)
+        os.replace(tmp, cache)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return data
+
+def load_centroid_x(in_dir, num_slots):
+    """
+    Load the x-position of the centroid in every lane, from the TPro exports
+    lane_N.avi_x.txt (first column) or from tracks.npy written by
+    centroid_tracker.py if the exports do not exist. Untracked frames of
+    tracks.npy are filled like in the exports, see centroid_tracker.fill_tracks.
+
+    Parameters
+    ----------
+    in_dir : string
+        analysis_output directory of an experiment.
+    num_slots : int
+        Number of lanes.
+
+    Returns
+    -------
+    2D np.array of type float64
+        x-position with shape (frames, num_slots).
+    """
+    tracks_path = os.path.join(in_dir, 'tracks.npy')
+    if not os.path.exists(os.path.join(in_dir, 'lane_0.avi_x.txt')) and \
+            os.path.exists(tracks_path):
+        tracks = np.load(tracks_path, mmap_mode='r')
+        return fill_tracks(tracks[:, :num_slots, :1])[:, :, 0]
+    columns = [load_export(os.path.join(in_dir, f'lane_{lane_id}.avi_x.txt'))[:, 0]
+               for lane_id in range(num_slots)]
+    return np.stack(columns, axis=1)
+
+def main(exp_dir):
+    """
+    Build the cache of every TPro export (lane_N.avi_*.txt) in exp_dir and
+    its subdirectories, e.g. before analysing a whole genotype sweep.
+
+    Parameters
+    ----------
+    exp_dir : string
+        Root directory of the experiments.
+    """
+    count = 0
+    for root, dirs, files in os.walk(exp_dir):
+        for name in sorted(files):
+            if name.startswith('lane_') and '.avi_' in name and name.endswith('.txt'):
+                load_export(os.path.join(root, name))
+                count += 1
+    print(f'cached {count} exports')
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
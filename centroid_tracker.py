@@ -0,0 +1,237 @@
+#! /anaconda3/bin/python
+
+import os.path
+import csv
+import time
+import multiprocessing
+import argh
+import numpy as np
+from virtual_stack import open_mmstack, virtual_stack
+
+def read_lanes(input_dir):
+    """
+    Read the lane boundaries written by step_1.
+
+    Parameters
+    ----------
+    input_dir : string
+        Directory with lanes.csv.
+
+    Returns
+    -------
+    list of int
+        First and last row of each lane.
+    """
+    with open(os.path.join(input_dir, 'lanes.csv'), 'r') as fp:
+        return [int(v) for v in next(csv.reader(fp))]
+
+def background_images(video, lanes, n_samples=200):
+    """
+    This function estimates the background of each lane as the median of
+    frames sampled evenly over the recording.
+
+    Parameters
+    ----------
+    video : 3D np.array or virtual_stack
+        Frames with shape (frames, rows, columns).
+    lanes : list of int
+        First and last row of each lane.
+    n_samples : int, default=200
+        Number of frames used for the median.
+
+    Returns
+    -------
+    list of 2D np.array of type float32
+        Background image of each lane.
+    """
+    indices = np.linspace(0, len(video) - 1, min(n_samples, len(video))).astype(int)
+    samples = np.stack([video[int(i)] for i in indices])
+    background = np.median(samples, axis=0).astype(np.float32)
+    return [background[lanes[i]:lanes[i + 1]] for i in range(0, len(lanes) - 1, 2)]
+
+def track_chunk(chunk, background, thresh=8000):
+    """
+    This function computes centroid and body axis of the fly in a block of
+    frames of one lane from the image moments of the foreground mask.
+
+    Parameters
+    ----------
+    chunk : 3D np.array
+        Frames of one lane with shape (frames, rows, columns).
+    background : 2D np.array
+        Background image of the lane.
+    thresh : float, default=8000
+        Minimal absolute difference to the background of a fly pixel.
+
+    Returns
+    -------
+    x, y, angle : 1D np.arrays
+        Centroid in pixels and body axis in degrees [0, 180) for each frame,
+        in the coordinates of the TPro exports: x is the 1-based column,
+        y is the lane height minus the 1-based row, and angle is measured
+        upwards. Frames without foreground are nan.
+    """
+    mask = (np.abs(chunk.astype(np.float32) - background) > thresh).astype(np.float32)
+    height, width = mask.shape[1:]
+    rows = np.arange(height, dtype=np.float32)
+    cols = np.arange(width, dtype=np.float32)
+    row_sums = mask.sum(axis=2)
+    col_sums = mask.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m00 = row_sums.sum(axis=1)
+        row_mean = row_sums @ rows / m00
+        col_mean = col_sums @ cols / m00
+        mu20 = col_sums @ cols**2 / m00 - col_mean**2
+        mu02 = row_sums @ rows**2 / m00 - row_mean**2
+        mu11 = np.einsum('nij,i,j->n', mask, rows, cols) / m00 - row_mean * col_mean
+
+    # image rows point down, TPro angles and y point up
+    angle = np.degrees(-0.5 * np.arctan2(2 * mu11, mu20 - mu02)) % 180
+    return col_mean + 1, height - (row_mean + 1), angle
+
+def fill_missing(values):
+    """
+    Replace nan entries by the last valid value (the first valid value at the
+    start of the trace).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    if not np.any(valid):
+        return values
+    idx = np.where(valid, np.arange(len(values)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    idx[:np.argmax(valid)] = np.argmax(valid)
+    return values[idx]
+
+def fill_tracks(tracks):
+    """
+    Copy of tracks (frames, lanes, 3) with the untracked frames of every
+    lane filled by fill_missing, as the TPro exports hold no gaps.
+    """
+    filled = np.empty(tracks.shape, dtype=np.float64)
+    for lane_id in range(tracks.shape[1]):
+        for k in range(tracks.shape[2]):
+            filled[:, lane_id, k] = fill_missing(tracks[:, lane_id, k])
+    return filled
+
+def _track_range(args):
+    """
+    Track all lanes in the frames start to stop. Runs in a worker process,
+    which opens the memory-mapped stack itself.
+    """
+    paths, lanes, backgrounds, start, stop, thresh, chunk_size = args
+    video = virtual_stack(paths)
+    result = np.empty((stop - start, len(backgrounds), 3), dtype=np.float32)
+    for chunk_start, chunk in video.iter_chunks(chunk_size, start, stop):
+        for lane_id, background in enumerate(backgrounds):
+            lane = chunk[:, lanes[2*lane_id]:lanes[2*lane_id+1], :]
+            x, y, angle = track_chunk(lane, background, thresh)
+            result[chunk_start - start:chunk_start - start + len(chunk), lane_id] = \
+                np.stack((x, y, angle), axis=1)
+    video.close()
+    return result
+
+def track(video, lanes, thresh=8000, workers=0, chunk_size=200, n_background=200):
+    """
+    This function tracks the fly in every lane in one pass over the frames.
+    Frame ranges are processed in parallel by worker processes.
+
+    Parameters
+    ----------
+    video : virtual_stack
+        Recording opened with virtual_stack.open_mmstack.
+    lanes : list of int
+        First and last row of each lane.
+    thresh : float, default=8000
+        Minimal absolute difference to the background of a fly pixel.
+    workers : int, default=0
+        Number of worker processes. If 0, the number of cores.
+    chunk_size : int, default=200
+        Number of frames processed at once.
+    n_background : int, default=200
+        Number of frames used to estimate the background.
+
+    Returns
+    -------
+    tracks : 3D np.array of type float32
+        Array with shape (frames, lanes, 3) holding x, y and angle, see
+        track_chunk; nan in frames without a fly.
+    backgrounds : list of 2D np.array
+        Background image of each lane.
+    """
+    backgrounds = background_images(video, lanes, n_background)
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+    bounds = np.linspace(0, len(video), max(1, workers) + 1).astype(int)
+    tasks = [(video.paths, lanes, backgrounds, bounds[i], bounds[i + 1], thresh, chunk_size)
+             for i in range(len(bounds) - 1) if bounds[i + 1] > bounds[i]]
+    start_time = time.time()
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_track_range, tasks)
+    else:
+        results = [_track_range(task) for task in tasks]
+    tracks = np.concatenate(results, axis=0)
+    print(f'tracked {len(tracks)} frames, {len(tracks) / (time.time() - start_time):.1f} frames/s')
+    return tracks, backgrounds
+
+def save_tracks(output_dir, tracks, backgrounds, text_export=False):
+    """
+    Save the tracks as tracks.npy with shape (frames, lanes, 3) holding x, y
+    and angle, and the background of lane N as lane_N_background.npy.
+    Untracked frames stay nan in tracks.npy, so the orientation check can
+    skip them; readers that need a value in every frame use fill_tracks.
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory where output is stored.
+    tracks : 3D np.array
+        Output of track.
+    backgrounds : list of 2D np.array
+        Background image of each lane.
+    text_export : bool, default=False
+        Also write lane_N.avi_x.txt, lane_N.avi_y.txt and lane_N.avi_angle.txt
+        in the format of the TPro exports, with untracked frames filled.
+    """
+    np.save(os.path.join(output_dir, 'tracks.npy'), tracks)
+    if text_export:
+        filled = fill_tracks(tracks)
+    for lane_id, background in enumerate(backgrounds):
+        np.save(os.path.join(output_dir, f'lane_{lane_id}_background.npy'), background)
+        if not text_export:
+            continue
+        for k, name in enumerate(['x', 'y', 'angle']):
+            np.savetxt(os.path.join(output_dir, f'lane_{lane_id}.avi_{name}.txt'),
+                       filled[:, lane_id, k], fmt='%.3f')
+
+def main(path_tif, output_dir, thresh=8000, workers=0, chunk_size=200, text_export=False):
+    """
+    Centroid tracking step. Can replace the TPro.exe call of tprocall.bat,
+    see step2_centroidTracking_python.bat.
+
+    Parameters
+    ----------
+    path_tif : string
+        Path to tif stack with video frames.
+    output_dir : string
+        Directory with lanes.csv from step_1, where output is stored.
+    thresh : float, default=8000
+        Minimal absolute difference to the background of a fly pixel.
+    workers : int, default=0
+        Number of worker processes. If 0, the number of cores.
+    chunk_size : int, default=200
+        Number of frames processed at once.
+    text_export : bool, default=False
+        Also write the TPro style text exports.
+    """
+    print('start to read : '+path_tif)
+    video = open_mmstack(path_tif)
+    lanes = read_lanes(output_dir)
+    tracks, backgrounds = track(video, lanes, thresh, workers, chunk_size)
+    save_tracks(output_dir, tracks, backgrounds, text_export)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,432 @@
+#! /anaconda3/bin/python
+
+import os.path
+import argh
+import numpy as np
+import cv2
+import lane_store
+from lane_store import open_lane, lane_reader
+from frame_tables import save_table
+from centroid_cache import load_export
+
+def load_track(input_dir, lane_id):
+    """
+    Load x, y and angle of the fly in a lane from the TPro exports
+    lane_N.avi_x.txt, lane_N.avi_y.txt and lane_N.avi_angle.txt, or from
+    tracks.npy written by centroid_tracker.py if the exports do not exist.
+    The exports are read through centroid_cache. Frames that
+    centroid_tracker.py could not track are nan.
+
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory of an experiment.
+    lane_id : int
+        Lane number.
+
+    Returns
+    -------
+    x, y, angle : 1D np.arrays
+        Tracked position in pixels (y pointing up) and angle in degrees.
+    """
+    fname = os.path.join(input_dir, f'lane_{lane_id}.avi')
+    if not os.path.exists(fname + '_x.txt') and \
+            os.path.exists(os.path.join(input_dir, 'tracks.npy')):
+        tracks = np.load(os.path.join(input_dir, 'tracks.npy'), mmap_mode='r')
+        return [np.asarray(tracks[:, lane_id, k], dtype=np.float64) for k in range(3)]
+    return [np.array(load_export(f'{fname}_{name}.txt')[:, 0]) for name in ['x', 'y', 'angle']]
+
+def load_background(input_dir, lane_id):
+    """
+    Load the 8-bit background image of a lane, from the TPro output
+    lane_N.avi_tpro/background.png or from lane_N_background.npy written
+    by centroid_tracker.py.
+    """
+    png = os.path.join(input_dir, f'lane_{lane_id}.avi_tpro', 'background.png')
+    if os.path.exists(png):
+        return cv2.imread(png, cv2.IMREAD_GRAYSCALE)
+    background = np.load(os.path.join(input_dir, f'lane_{lane_id}_background.npy'))
+    if background.max() > np.iinfo(np.uint8).max:
+        background = background / 256.
+    return np.clip(np.round(background), 0, 255).astype(np.uint8)
+
+def read_frames(cap, indices):
+    """
+    Read the frames with the given sorted indices as 8-bit gray images,
+    see lane_store.read_frames.
+    """
+    for frame in lane_store.read_frames(cap, indices):
+        yield frame[..., 0] if isinstance(cap, lane_reader) else \
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+def matlab_round(values):
+    """
+    Round half away from zero like MATLAB's round.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+def box_geometry(x, y, height, width, box_size=80):
+    """
+    Geometry of the boxes cut by getOneFlyBoxImage_ in check_orient.m, for a
+    batch of frames. The function crops a square of 1.5 box_size around the
+    fly, clipped to the image; a crop that was shortened at the top or
+    bottom is pasted centred into a zero square, which moves the fly off
+    the centre near the edges of the lane. The square is rotated about its
+    centre and the central box_size square is cut out.
+
+    Parameters
+    ----------
+    x, y : 1D np.arrays
+        Position of the fly in MATLAB spatial coordinates (column, row),
+        i.e. the centre of the first pixel is 1, as the TPro values are
+        used by check_orient.m.
+    height, width : int
+        Image size.
+    box_size : int, default=80
+        Side length of the box, a multiple of 4 so that all MATLAB indices
+        are integers.
+
+    Returns
+    -------
+    dict of 1D np.arrays
+        'offset' (rows, columns) added to a pixel index of the square to
+        get the image index, 'window' (first row, last row, first column,
+        last column) of the square that holds image pixels, 'size' (rows,
+        columns) of the square, 'crop' (first row, first column) of the
+        box in the rotated square and 'box' (rows, columns) of the box.
+        All indices are 1-based.
+    """
+    assert box_size % 4 == 0, 'box_size has to be a multiple of 4'
+    trim = box_size * 3 // 2
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # rectangle [x y w h] with the corrections of getOneFlyBoxImage_
+    rect_x = x - trim / 2.
+    rect_y = y - trim / 2.
+    rect_h = np.full(len(y), float(trim))
+    top = rect_y < 0
+    rect_h[top] += np.floor(rect_y[top]) * 2
+    rect_y[top] = 0
+    bottom = rect_y + trim > height
+    rect_h[bottom] -= np.floor(rect_y[bottom])
+    rect_y[bottom] *= 2
+
+    # imcrop: pixels round(r) to round(r + h), clipped to the image
+    r1, r2 = matlab_round(rect_y), matlab_round(rect_y + rect_h)
+    c1, c2 = matlab_round(rect_x), matlab_round(rect_x + trim)
+    outside = (r1 > height) | (r2 < 1) | (c1 > width) | (c2 < 1)
+    r1, r2 = np.maximum(r1, 1), np.minimum(r2, height)
+    c1, c2 = np.maximum(c1, 1), np.minimum(c2, width)
+    crop_h = np.where(outside, 0, np.maximum(r2 - r1 + 1, 0))
+    crop_w = np.where(outside, 0, np.maximum(c2 - c1 + 1, 0))
+
+    # shortened crops are pasted centred into a zero square; MATLAB grows
+    # the square if the crop does not fit
+    pasted = rect_h < trim
+    first_row = np.where(pasted, np.maximum(trim // 2 - np.floor(crop_h / 2), 1), 1)
+    first_col = np.where(pasted, np.maximum(trim // 2 - np.floor(crop_w / 2), 1), 1)
+    crop_w = np.where(pasted, np.minimum(crop_w, trim), crop_w)
+    last_row = first_row + crop_h - 1
+    last_col = first_col + crop_w - 1
+    rows = np.where(pasted, np.maximum(trim, last_row), crop_h)
+    cols = np.where(pasted, np.maximum(trim, last_col), crop_w)
+
+    # imcrop of the box out of the rotated square, cut to box_size
+    start = matlab_round((trim - box_size) / 2.)
+    stop = matlab_round((trim + box_size) / 2.)
+    box_h = np.clip(np.minimum(stop, rows) - start + 1, 0, box_size)
+    box_w = np.clip(np.minimum(stop, cols) - start + 1, 0, box_size)
+    return {'offset': (r1 - first_row, c1 - first_col),
+            'window': (first_row, last_row, first_col, last_col),
+            'size': (rows, cols), 'crop': (start, start), 'box': (box_h, box_w)}
+
+def fly_box_images(images, x, y, angle, box_size=80):
+    """
+    Crop fly-centred boxes out of a batch of images and rotate them so that
+    the body axis of the fly is vertical, like getOneFlyBoxImage_ in
+    check_orient.m (crop, imrotate(270 - angle, 'crop', 'bilinear'),
+    crop box_size), including its handling of flies near the image border,
+    see box_geometry. All boxes are sampled at once with bilinear
+    interpolation and rounded to uint8 like imrotate.
+
+    Parameters
+    ----------
+    images : 3D np.array
+        Images with shape (n, rows, columns).
+    x, y : 1D np.arrays
+        Position of the fly in MATLAB spatial coordinates (column, row).
+    angle : 1D np.array
+        Angle of the fly in degrees.
+    box_size : int, default=80
+        Side length of the box.
+
+    Returns
+    -------
+    boxes : 3D np.array of type uint8
+        Boxes with shape (n, box_size, box_size).
+    valid : 3D np.array of type bool
+        False for the pixels beyond the box that MATLAB cuts at the border
+        of a shortened square.
+    """
+    n, height, width = images.shape
+    geometry = box_geometry(x, y, height, width, box_size)
+    expand = lambda v: np.asarray(v, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    off_r, off_c = [expand(v) for v in geometry['offset']]
+    row_lo, row_hi, col_lo, col_hi = [expand(v) for v in geometry['window']]
+    rows, cols = [expand(v) for v in geometry['size']]
+    box_h, box_w = [expand(v) for v in geometry['box']]
+    idx = np.arange(box_size, dtype=np.float64)
+
+    # imrotate turns the square counterclockwise about ((rows+1)/2, (cols+1)/2)
+    centre_r, centre_c = (rows + 1) / 2., (cols + 1) / 2.
+    dy = geometry['crop'][0] + idx[np.newaxis, :, np.newaxis] - centre_r
+    dx = geometry['crop'][1] + idx[np.newaxis, np.newaxis, :] - centre_c
+    theta = np.radians(270. - expand(angle))
+    cos, sin = np.cos(theta), np.sin(theta)
+    src_c = centre_c + cos * dx - sin * dy
+    src_r = centre_r + sin * dx + cos * dy
+
+    # bilinear interpolation, pixels of the square outside the crop are 0
+    r0, c0 = np.floor(src_r), np.floor(src_c)
+    wr, wc = src_r - r0, src_c - c0
+    frame = np.arange(n)[:, np.newaxis, np.newaxis]
+    def corner(r, c):
+        inside = (r >= row_lo) & (r <= row_hi) & (c >= col_lo) & (c <= col_hi)
+        r_img = np.clip(r + off_r - 1, 0, height - 1).astype(np.intp)
+        c_img = np.clip(c + off_c - 1, 0, width - 1).astype(np.intp)
+        return np.where(inside, images[frame, r_img, c_img], 0)
+    values = ((1 - wr) * ((1 - wc) * corner(r0, c0) + wc * corner(r0, c0 + 1)) +
+              wr * ((1 - wc) * corner(r0 + 1, c0) + wc * corner(r0 + 1, c0 + 1)))
+    boxes = np.clip(matlab_round(values), 0, 255).astype(np.uint8)
+    valid = (idx[np.newaxis, :, np.newaxis] < box_h) & (idx[np.newaxis, np.newaxis, :] < box_w)
+    return boxes, valid
+
+def otsu_levels(boxes, valid):
+    """
+    Otsu threshold of every box, like graythresh in MATLAB: the mean of the
+    histogram bins that maximise the between-class variance, 0 if the box
+    has a single gray level.
+
+    Parameters
+    ----------
+    boxes : 3D np.array of type uint8
+        Boxes with shape (n, rows, columns).
+    valid : 3D np.array of type bool
+        Pixels that belong to the box.
+
+    Returns
+    -------
+    1D np.array of float
+        Threshold of each box in gray levels; pixels above it are foreground.
+    """
+    n = len(boxes)
+    bins = np.arange(n)[:, np.newaxis, np.newaxis] * 256 + boxes
+    counts = np.bincount(bins[valid], minlength=n * 256).reshape(n, 256)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = counts / counts.sum(axis=1, keepdims=True)
+        omega = np.cumsum(p, axis=1)
+        mu = np.cumsum(p * np.arange(1, 257), axis=1)
+        sigma_b = (mu[:, -1:] * omega - mu)**2 / (omega * (1 - omega))
+    sigma_b[~np.isfinite(sigma_b)] = -np.inf
+    max_val = sigma_b.max(axis=1, keepdims=True)
+    is_max = (sigma_b == max_val) & np.isfinite(max_val)
+    with np.errstate(invalid='ignore'):
+        idx = (is_max * np.arange(1, 257)).sum(axis=1) / is_max.sum(axis=1)
+    return np.where(np.isfinite(idx), idx - 1, 0.)
+
+def side_view_flags(images, background, x, rows, angle, box_size=80, side_th=15):
+    """
+    Classify a batch of frames as side view (1) or not (0). As in
+    check_orient.m, box pixels above 20 are set to 255 and the box is
+    binarized with its Otsu threshold (imbinarize). A frame is a side view
+    if fly pixels in the box touch exactly one of its left and right
+    borders.
+
+    Parameters
+    ----------
+    images : 3D np.array of type uint8
+        Gray frames with shape (n, rows, columns).
+    background : 2D np.array
+        8-bit background image of the lane.
+    x, rows : 1D np.arrays
+        Position of the fly in MATLAB spatial coordinates (column, row).
+    angle : 1D np.array
+        Angle of the fly in degrees.
+    box_size : int, default=80
+        Side length of the box around the fly.
+    side_th : int, default=15
+        Width of the left and right border of the box.
+
+    Returns
+    -------
+    1D np.array of type bool
+        Side view flag for each frame.
+    """
+    # uint8 subtraction saturates at 0
+    images = np.clip(np.asarray(background, dtype=np.float32) - images, 0, 255)
+    boxes, valid = fly_box_images(images, x, rows, angle, box_size)
+    boxes[boxes > 20] = 255
+    levels = otsu_levels(boxes, valid)
+    fly = valid & (boxes > levels[:, np.newaxis, np.newaxis])
+    # the right border is taken from the columns MATLAB kept of each box
+    col = np.arange(box_size)[np.newaxis, np.newaxis, :]
+    box_w = valid.sum(axis=2).max(axis=1)[:, np.newaxis, np.newaxis]
+    left = np.any(fly & (col < side_th), axis=(1, 2))
+    right = np.any(fly & (col >= box_w - side_th), axis=(1, 2))
+    return left != right
+
+def duration_filter(flags, min_duration):
+    """
+    Remove runs of nonzero entries shorter than min_duration (durationFilter
+    in check_orient.m).
+
+    Parameters
+    ----------
+    flags : 1D np.array of int
+        Orientation flags of one lane.
+    min_duration : int
+        Minimal run length in frames.
+
+    Returns
+    -------
+    1D np.array of int
+        Filtered flags.
+    """
+    flags = np.array(flags)
+    on = np.concatenate(([0], (flags > 0).astype(np.int8), [0]))
+    starts = np.flatnonzero(np.diff(on) == 1)
+    stops = np.flatnonzero(np.diff(on) == -1)
+    for start, stop in zip(starts, stops):
+        if stop - start < min_duration:
+            flags[start:stop] = 0
+    return flags
+
+def gap_filter(flags, gap_frames):
+    """
+    Fill gaps of zeros shorter than gap_frames that follow a nonzero entry
+    (gapFilter in check_orient.m).
+
+    Parameters
+    ----------
+    flags : 1D np.array of int
+        Orientation flags of one lane.
+    gap_frames : int
+        Gaps with less than gap_frames zeros are filled.
+
+    Returns
+    -------
+    1D np.array of int
+        Filtered flags.
+    """
+    flags = np.array(flags)
+    on = np.concatenate(([1], (flags > 0).astype(np.int8), [1]))
+    starts = np.flatnonzero(np.diff(on) == -1)
+    stops = np.flatnonzero(np.diff(on) == 1)
+    for start, stop in zip(starts, stops):
+        # the gap has to lie between two nonzero entries and, as in the
+        # MATLAB loop, start before the last gap_frames frames
+        if start == 0 or stop == len(flags) or start > len(flags) - gap_frames:
+            continue
+        if stop - start < gap_frames:
+            flags[start:stop] = flags[start - 1]
+    return flags
+
+def near_edge(x, y, height, y_th):
+    """
+    Frames in which the fly is within y_th of the top or bottom of the lane,
+    the y pre-check of check_orient.m. Frames without a track (nan, e.g. an
+    empty lane in centroid_tracker output) are never candidates.
+    """
+    with np.errstate(invalid='ignore'):
+        return np.isfinite(x) & np.isfinite(y) & ~((height - y > y_th) & (y > y_th))
+
+def check_lane(input_dir, lane_id, box_size=80, y_th=35, side_th=15, batch_size=500):
+    """
+    Flag the frames of one lane in which the fly is seen from the side.
+    Only frames in which the fly is within y_th of the top or bottom of the
+    lane are read.
+
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory of an experiment.
+    lane_id : int
+        Lane number.
+    box_size : int, default=80
+        Side length of the box around the fly.
+    y_th : float, default=35
+        Frames with the fly further than y_th from both edges are skipped.
+    side_th : int, default=15
+        Width of the left and right border of the box that is searched
+        for fly pixels.
+    batch_size : int, default=500
+        Number of frames processed at once.
+
+    Returns
+    -------
+    1D np.array of int
+        1 for frames in which fly pixels touch only one side of the box.
+    """
+    cap = open_lane(input_dir, lane_id)
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    background = load_background(input_dir, lane_id)
+    x, y, angle = load_track(input_dir, lane_id)
+    n_frames = min(n_frames, len(x))
+    x, y, angle = x[:n_frames], y[:n_frames], angle[:n_frames]
+
+    output = np.zeros(n_frames, dtype=int)
+    candidates = np.flatnonzero(near_edge(x, y, height, y_th) & np.isfinite(angle))
+    print(f'lane_{lane_id}: {len(candidates)} of {n_frames} frames near the edge')
+    frames = read_frames(cap, candidates)
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        images = np.stack([next(frames) for i in batch])
+        output[batch] = side_view_flags(images, background, x[batch], height - y[batch],
+                                        angle[batch], box_size, side_th)
+    cap.release()
+    return output
+
+def main(input_dir, output_dir, box_size=80, y_th=35, side_th=15, gap=30, duration=10,
+         num_slots=4, table_format='txt'):
+    """
+    Python port of check_orient.m. Writes corrected_orient.txt with one
+    tab separated column per lane, 1 for frames with the fly seen from the side.
+
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory with the lane videos and tracking output.
+    output_dir : string
+        Directory where corrected_orient.txt is stored.
+    box_size : int, default=80
+        Side length of the box around the fly.
+    y_th : float, default=35
+        Frames with the fly further than y_th from both edges are skipped.
+    side_th : int, default=15
+        Width of the left and right border of the box.
+    gap : int, default=30
+        Gaps shorter than this are filled.
+    duration : int, default=10
+        Side views shorter than this are removed.
+    num_slots : int, default=4
+        Number of lanes.
+    table_format : {'txt', 'npy', 'both'}, default='txt'
+        Write corrected_orient.txt, an int8 corrected_orient.npy or both.
+    """
+    columns = []
+    for lane_id in range(num_slots):
+        output = check_lane(input_dir, lane_id, box_size, y_th, side_th)
+        output = duration_filter(output, duration)
+        output = gap_filter(output, gap)
+        columns.append(output)
+    n_frames = min(len(c) for c in columns)
+    csv_output = np.stack([c[:n_frames] for c in columns], axis=1)
+    print('output corrected_orient table : ' + output_dir)
+    save_table(output_dir, 'corrected_orient', csv_output, table_format)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,22 @@
+import sys
+import argh
+
+def dispatch(main, commands):
+    """
+    Command line entry of a script with a main function and subcommands
+    such as batch. The subcommands are run as `python X.py batch ...`, any
+    other command line goes to main, so `python X.py in_dir ...` works as
+    it did before the subcommands were added.
+
+    Parameters
+    ----------
+    main : callable
+        Default command.
+    commands : list of callables
+        Subcommands, called by their function name.
+    """
+    names = [function.__name__.replace('_', '-') for function in commands]
+    if len(sys.argv) > 1 and sys.argv[1] in names:
+        argh.dispatch_commands(commands)
+    else:
+        argh.dispatch_command(main)
@@ -0,0 +1,229 @@
+import os.path
+import json
+import functools
+import subprocess
+import tempfile
+import numpy as np
+
+# encoders for codecs that ffmpeg cannot encode under their own name
+ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+
+# stream parameters that have to match for stream copied and re-encoded
+# parts to be concatenated without re-encoding
+STREAM_KEYS = ['codec', 'profile', 'pix_fmt', 'width', 'height', 'time_base']
+
+def probe_video(path, count_frames=False):
+    """
+    Read the codec and frame rate of the video stream with ffprobe. Only
+    the header is read, unless the frames are counted.
+
+    Parameters
+    ----------
+    path : string
+        Path of the video.
+    count_frames : bool, default=False
+        Also count the packets of the stream (one per frame), which reads
+        the whole file but decodes nothing.
+
+    Returns
+    -------
+    dict
+        'codec', 'profile', 'pix_fmt', 'width', 'height', 'time_base',
+        'fps' (strings, e.g. '25/1') and, if count_frames, 'n_frames'.
+    """
+    count_args = ['-count_packets'] if count_frames else []
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0']
+                                     + count_args +
+                                     ['-show_entries', 'stream=codec_name,profile,pix_fmt,width,'
+                                      'height,time_base,r_frame_rate,nb_read_packets',
+                                      '-of', 'json', path])
+    stream = json.loads(output)['streams'][0]
+    info = {'codec': stream['codec_name'], 'profile': stream.get('profile'),
+            'pix_fmt': stream['pix_fmt'], 'width': stream['width'], 'height': stream['height'],
+            'time_base': stream['time_base'], 'fps': stream['r_frame_rate']}
+    if count_frames:
+        info['n_frames'] = int(stream['nb_read_packets'])
+    return info
+
+@functools.lru_cache(maxsize=16)
+def _read_keyframes(path, size, mtime_ns):
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                      '-show_entries', 'packet=pts,dts,flags',
+                                      '-of', 'csv=p=0', path], universal_newlines=True)
+    rows = [line.split(',') for line in output.splitlines() if line]
+    # frame order is presentation order
+    pts = np.array([int(pts if pts != 'N/A' else dts) for pts, dts, flags in rows],
+                   dtype=np.int64)
+    key = np.array(['K' in flags for pts, dts, flags in rows], dtype=bool)
+    keyframes = np.flatnonzero(key[np.argsort(pts, kind='stable')])
+    keyframes.flags.writeable = False
+    return keyframes, len(rows)
+
+def probe_keyframes(path):
+    """
+    Find the keyframes of the video stream from the packet flags, without
+    decoding. The result is cached as long as the file is unchanged.
+
+    Parameters
+    ----------
+    path : string
+        Path of the video.
+
+    Returns
+    -------
+    keyframes : 1D np.array of int
+        Sorted frame indices of the keyframes (read-only).
+    n_frames : int
+        Number of frames of the video.
+    """
+    stat = os.stat(path)
+    return _read_keyframes(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def merge_ranges(starts, stops):
+    """
+    Merge sorted frame ranges [start, stop) that touch into contiguous ranges.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    if len(starts) == 0:
+        return starts, stops
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] != stops[:-1]
+    ends = np.hstack((np.flatnonzero(new)[1:] - 1, len(starts) - 1))
+    return starts[new], stops[ends]
+
+def cut_list(starts, stops, keyframes, n_frames):
+    """
+    Split frame ranges into parts that can be stream copied and parts that
+    have to be re-encoded. A part is copied if it starts at a keyframe and
+    ends at a keyframe or at the end of the video; the partial GOPs at the
+    edges of a range are re-encoded.
+
+    Parameters
+    ----------
+    starts, stops : 1D np.arrays of int
+        Sorted, non-overlapping frame ranges [start, stop).
+    keyframes : 1D np.array of int
+        Sorted keyframe indices of the video.
+    n_frames : int
+        Number of frames of the video.
+
+    Returns
+    -------
+    list of (int, int, bool)
+        First frame, end frame (exclusive) and whether to copy the part.
+    """
+    bounds = np.append(keyframes, n_frames)
+    parts = []
+    for start, stop in zip(starts, stops):
+        first = bounds[min(np.searchsorted(bounds, start), len(bounds) - 1)]
+        last_idx = np.searchsorted(bounds, stop, side='right') - 1
+        last = bounds[last_idx] if last_idx >= 0 else start
+        if first >= last:
+            parts.append((int(start), int(stop), False))
+            continue
+        if start < first:
+            parts.append((int(start), int(first), False))
+        parts.append((int(first), int(last), True))
+        if last < stop:
+            parts.append((int(last), int(stop), False))
+    return parts
+
+def matches_stream(path, info):
+    """
+    True if the video stream of path has the STREAM_KEYS parameters of info.
+    """
+    part_info = probe_video(path)
+    return all(part_info[key] == info[key] for key in STREAM_KEYS)
+
+def write_parts(input_path, parts, tmp_dir, info, reencode_args):
+    """
+    Cut the parts of cut_list out of the video into tmp_dir.
+
+    Returns
+    -------
+    list of strings
+        Paths of the parts.
+    """
+    fps_num, fps_den = [int(v) for v in info['fps'].split('/')]
+    encoder = ENCODERS.get(info['codec'], info['codec'])
+    ext = os.path.splitext(input_path)[1]
+    part_paths = []
+    for k, (start, stop, copy) in enumerate(parts):
+        part_path = os.path.join(tmp_dir, f'part_{k:05d}{ext}')
+        # exact start time of the first frame of the part
+        seek = repr(start * fps_den / fps_num)
+        if copy:
+            codec_args = ['-c:v', 'copy']
+        else:
+            codec_args = ['-c:v', encoder, '-pix_fmt', info['pix_fmt']] + list(reencode_args)
+        subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-ss', seek,
+                               '-i', input_path, '-frames:v', str(stop - start), '-an']
+                              + codec_args + [part_path])
+        part_paths.append(part_path)
+    return part_paths
+
+def concat_parts(part_paths, output_path, tmp_dir):
+    """
+    Join the parts without re-encoding (ffmpeg concat demuxer).
+    """
+    list_path = os.path.join(tmp_dir, 'parts.txt')
+    with open(list_path, 'w') as fp:
+        for part_path in part_paths:
+            fp.write("file '" + part_path.replace("'", "'\\''") + "'\n")
+    subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                           '-i', list_path, '-c', 'copy', output_path])
+
+def export_clips(input_path, starts, stops, output_path, reencode_args=('-q:v', '2')):
+    """
+    Write the frame ranges of a video into one video, stream copying whole
+    GOPs and re-encoding only the frames at the edges of each range with the
+    codec of the input. The output holds exactly the frames of the ranges,
+    in order.
+
+    Copied and re-encoded parts can only be joined if the encoder reproduces
+    the stream parameters of the input (STREAM_KEYS). If a re-encoded part
+    differs, or the joined video does not have the expected number of
+    frames, all ranges are re-encoded instead. A RuntimeError is raised if
+    that fails as well.
+
+    Parameters
+    ----------
+    input_path : string
+        Path of the input video, e.g. lane_0.avi.
+    starts, stops : 1D np.arrays of int
+        Sorted, non-overlapping frame ranges [start, stop).
+    output_path : string
+        Path of the video to write.
+    reencode_args : sequence of strings, default=('-q:v', '2')
+        Encoder options for the re-encoded frames.
+
+    Returns
+    -------
+    copied : int
+        Number of frames that were stream copied.
+    """
+    info = probe_video(input_path)
+    keyframes, n_input = probe_keyframes(input_path)
+    starts, stops = merge_ranges(starts, stops)
+    n_frames = int(np.sum(stops - starts))
+    parts = cut_list(starts, stops, keyframes, n_input)
+    attempts = [parts]
+    if any(copy for start, stop, copy in parts):
+        attempts.append([(int(start), int(stop), False) for start, stop in zip(starts, stops)])
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        for attempt in attempts:
+            part_dir = tempfile.mkdtemp(dir=tmp_dir)
+            part_paths = write_parts(input_path, attempt, part_dir, info, reencode_args)
+            mixed = len(set(copy for start, stop, copy in attempt)) > 1
+            if mixed and not all(matches_stream(path, info)
+                                 for path, (start, stop, copy) in zip(part_paths, attempt) if not copy):
+                print(f're-encoded parts do not match the stream of {input_path}, re-encoding all frames')
+                continue
+            concat_parts(part_paths, output_path, part_dir)
+            written = probe_video(output_path, count_frames=True)['n_frames']
+            if written == n_frames:
+                return sum(stop - start for start, stop, copy in attempt if copy)
+            print(f'{written} of {n_frames} frames written to {output_path}')
+    raise RuntimeError(f'failed to write {n_frames} frames to {output_path}')
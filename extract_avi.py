@@ -1,67 +1,102 @@
 #! /anaconda3/bin/python
 
 import os.path
-import shutil
-from subprocess import call
-import csv
-import argh
 import numpy as np
-import cv2
-import time
-from skimage import io
+from lane_store import open_lane, route_frames
+from frame_tables import load_table
+from lane_pool import find_experiments, write_frame_map, run_tasks
+from cli import dispatch
 
-def main(input_dir, max_frame = 18000):
-    print('start to read : '+input_dir)
-    roi_file = input_dir + '/corrected_ROIs.txt'
-    orient_file = input_dir + '/corrected_orient.txt'
+def select_frames(roi_list, orient_list, lane_id):
+    """
+    Frames of a lane with the fly seen from the top in ROI 0, 2, 3 or 5,
+    and their ROI.
+
+    Parameters
+    ----------
+    roi_list, orient_list : 2D np.arrays
+        corrected_ROIs and corrected_orient tables.
+    lane_id : int
+        Lane number.
+
+    Returns
+    -------
+    2D np.array of int
+        Frame number and ROI of each selected frame, as in lane_N_top.txt.
+    """
+    n_frames = min(len(roi_list), len(orient_list))
+    roi = roi_list[:n_frames, lane_id]
+    orient = orient_list[:n_frames, lane_id]
+    frames = np.flatnonzero((orient == 0) & np.isin(roi, [0, 2, 3, 5]))
+    return np.column_stack((frames, roi[frames]))
 
-    path, folder = os.path.split(input_dir)
-    if folder == 'analysis_output':
-        path, folder = os.path.split(path)
+def extract_lane(input_dir, lane_id, roi_list=None, orient_list=None):
+    """
+    Write the frames of a lane selected by select_frames to lane_N_top.avi,
+    and frame number and ROI of every frame of the video to lane_N_top.txt.
+    The frame map is written last and marks the lane as done, also if no
+    frame was selected.
 
-    roi_list = list(csv.reader(open(roi_file, 'rt'), delimiter='\t'))
-    orient_list = list(csv.reader(open(orient_file, 'rt'), delimiter='\t'))
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory of an experiment.
+    lane_id : int
+        Lane number.
+    roi_list, orient_list : 2D np.arrays, optional
+        corrected_ROIs and corrected_orient tables; loaded if not given.
+    """
+    print('start to process lane :'+str(lane_id))
+    if roi_list is None:
+        roi_list = load_table(input_dir, 'corrected_ROIs')
+    if orient_list is None:
+        orient_list = load_table(input_dir, 'corrected_orient')
+    frame_map = select_frames(roi_list, orient_list, lane_id)
+    print(f'{len(frame_map)} of {min(len(roi_list), len(orient_list))} frames selected')
 
-    for lane_id in range(len(roi_list[0])):
-        print('start to process lane :'+str(lane_id))
-        
-        # open avi
-        cap = cv2.VideoCapture(input_dir+'/lane_'+str(lane_id)+'.avi')
-        
-        # make temporary frames
-        tmpPath = 'tmp_'+folder+'_lane_'+str(lane_id)
-        
-        if os.path.exists(tmpPath):
-            shutil.rmtree(tmpPath)
-            time.sleep(3)
-        os.makedirs(tmpPath)
+    # open avi; the selected frames are decoded in one forward pass and
+    # streamed into ffmpeg
+    cap = open_lane(input_dir, lane_id)
+    route_frames(cap, [(frame_map[:, 0], os.path.join(input_dir, f'lane_{lane_id}_top.avi'))])
+    cap.release()
+    write_frame_map(os.path.join(input_dir, f'lane_{lane_id}_top.txt'), frame_map)
+
+def main(input_dir, max_frame = 18000):
+    print('start to read : '+input_dir)
 
-        j = 0
-        for i in range(len(roi_list)):
-            if i % 100 == 0:
-                print('frame: '+str(i))
-            roi = int(roi_list[i][lane_id])
-            orient = int(orient_list[i][lane_id])
-            
-            if orient==0 and (roi==0 or roi==2 or roi==3 or roi==5):
-                frame_no = (i / max_frame)
-                cap.set(1,i);
-                ret, frame = cap.read()
+    roi_list = load_table(input_dir, 'corrected_ROIs')
+    orient_list = load_table(input_dir, 'corrected_orient')
 
-                #Store this frame to an image
-                #cv2.imwrite('tmpframes/ext_'+str(i)+'.jpg', frame)
-                io.imsave(f'{tmpPath}/ext_{j}.tif', frame)
-                j = j + 1
+    for lane_id in range(roi_list.shape[1]):
+        extract_lane(input_dir, lane_id, roi_list, orient_list)
 
-        # release object
-        cap.release()
+def batch(exp_dir, workers=0, num_slots=4, reverse=False):
+    """
+    Extract the lanes of all experiments in exp_dir that have a
+    corrected_orient table but no lane_N_top.txt yet (or lane_N_top.avi,
+    written by earlier versions without the frame map). Every (experiment,
+    lane) pair is a task of a process pool. Exits
+    with status 1 if any lane failed.
 
-        video_output_path = os.path.join(input_dir, f'lane_{lane_id}_top.avi')
-        call(['ffmpeg', '-y', '-i', f'{tmpPath}/ext_%d.tif', video_output_path])
-        time.sleep(3)
-        shutil.rmtree(tmpPath)
-        time.sleep(3)
+    Parameters
+    ----------
+    exp_dir : string
+        Directory containing one directory per experiment.
+    workers : int, default=0
+        Number of worker processes. If 0, the number of cores.
+    num_slots : int, default=4
+        Number of lanes.
+    reverse : bool, default=False
+        Queue the experiments in reverse order.
+    """
+    tasks = [(input_dir, lane_id) for input_dir in find_experiments(exp_dir, reverse)
+             for lane_id in range(num_slots)
+             if not any(os.path.exists(os.path.join(input_dir, f'lane_{lane_id}_top.{ext}'))
+                        for ext in ['txt', 'avi'])]
+    failed = run_tasks(extract_lane, tasks, workers)
+    if failed:
+        raise SystemExit(f'{len(failed)} lanes failed')
 
 
 if __name__ == '__main__':
-    argh.dispatch_command(main)
+    dispatch(main, [batch])
@@ -1,135 +1,170 @@
 #! /anaconda3/bin/python
 
 import os.path
-import shutil
-from subprocess import call
-import csv
-import argh
 import numpy as np
-import cv2
-import time
-from skimage import io
-
-def main(input_dir, par_th = 0.95, max_frame = 18000):
+from lane_store import open_lane, route_frames
+from frame_tables import load_table
+from clip_export import export_clips
+from lane_pool import find_experiments, temp_output, replace_output, write_frame_map, run_tasks
+from cli import dispatch
+
+def bottom_fractions(roi_list, orient_list):
+    """
+    Fraction of frames with the fly seen from the top (orientation 0) in
+    every segment, from per-lane cumulative counts of the orientation table.
+
+    Parameters
+    ----------
+    roi_list : 2D np.array of int
+        ROI_frame_splits table; columns are ROI, first frame, end frame
+        (exclusive) and lane.
+    orient_list : 2D np.array of int
+        corrected_orient table with one column per lane.
+
+    Returns
+    -------
+    1D np.array of float
+        Fraction for each segment, nan for empty segments.
+    """
+    counts = np.zeros((len(orient_list) + 1, orient_list.shape[1]), dtype=np.int64)
+    np.cumsum(orient_list == 0, axis=0, out=counts[1:])
+    fstart, fend, lane = roi_list[:, 1], roi_list[:, 2], roi_list[:, 3]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (counts[fend, lane] - counts[fstart, lane]) / (fend - fstart)
+
+def load_top_segments(input_dir, par_th=0.95):
+    """
+    Load the ROI segments of an experiment and find the segments in which
+    the fly is seen from the top in at least par_th of the frames, for all
+    lanes at once. Empty segments, e.g. the all-zero first row of tables
+    written before ROI_track dropped it, are never selected.
+
+    Returns
+    -------
+    roi_list : 2D np.array of int
+        ROI_frame_splits table.
+    top : 1D np.array of bool
+        True for the segments seen from the top.
+    """
+    roi_list = load_table(input_dir, 'ROI_frame_splits').astype(np.int64)
+    orient_list = load_table(input_dir, 'corrected_orient')
+    fractions = bottom_fractions(roi_list, orient_list)
+    nonempty = roi_list[:, 2] > roi_list[:, 1]
+    return roi_list, nonempty & (np.where(nonempty, fractions, 0) >= par_th)
+
+def select_segments(roi_list, top, lane_id):
+    """
+    Segments of a lane seen from the top, and frame number and ROI of all
+    their frames.
+
+    Parameters
+    ----------
+    roi_list, top : np.arrays
+        Output of load_top_segments.
+    lane_id : int
+        Lane number.
+
+    Returns
+    -------
+    segments : 2D np.array of int
+        Selected rows of roi_list.
+    frame_map : 2D np.array of int
+        Frame number and ROI of each frame, as in lane_N_topbyroi.txt.
+    """
+    lane_rows = roi_list[:, 3] == lane_id
+    segments = roi_list[lane_rows & top]
+    print(f'process lane={lane_id}: {len(segments)} of {np.sum(lane_rows)} segments from the top')
+
+    lengths = segments[:, 2] - segments[:, 1]
+    offsets = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    frames = np.repeat(segments[:, 1], lengths) + offsets
+    return segments, np.column_stack((frames, np.repeat(segments[:, 0], lengths)))
+
+def extract_lane(input_dir, lane_id, par_th=0.95, stream_copy=False, roi_list=None, top=None):
+    """
+    Write the segments of a lane in which the fly is seen from the top to
+    lane_N_topbyroi.avi, and frame number and ROI of every frame of the
+    video to lane_N_topbyroi.txt. Outputs are written under temporary names
+    and renamed when complete.
+
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory of an experiment.
+    lane_id : int
+        Lane number.
+    par_th : float, default=0.95
+        Minimal fraction of frames seen from the top in a segment.
+    stream_copy : bool, default=False
+        Cut the segments out of lane_N.avi with ffmpeg, stream copying
+        whole GOPs and re-encoding only the frames at the segment edges
+        (see clip_export), instead of decoding and re-encoding every frame.
+    roi_list, top : np.arrays, optional
+        Output of load_top_segments; loaded if not given.
+    """
+    if roi_list is None:
+        roi_list, top = load_top_segments(input_dir, par_th)
+    segments, frame_map = select_segments(roi_list, top, lane_id)
+    frames = frame_map[:, 0]
+
+    video_output_path = os.path.join(input_dir, 'lane_'+str(lane_id)+'_topbyroi.avi')
+    map_output_path = os.path.join(input_dir, 'lane_'+str(lane_id)+'_topbyroi.txt')
+    tmp_path = temp_output(video_output_path)
+    if stream_copy:
+        if len(frames) > 0:
+            print('cut movie : '+video_output_path)
+            copied = export_clips(os.path.join(input_dir, 'lane_'+str(lane_id)+'.avi'),
+                                  segments[:, 1], segments[:, 2], tmp_path)
+            print(f'{copied} of {len(frames)} frames stream copied')
+            replace_output(tmp_path, video_output_path)
+        write_frame_map(map_output_path, frame_map)
+        return
+
+    # open avi; segments are sorted, so frames are decoded in one forward
+    # pass and streamed into ffmpeg
+    print('generage movie : '+video_output_path)
+    cap = open_lane(input_dir, lane_id)
+    route_frames(cap, [(frames, video_output_path)])
+    cap.release()
+    write_frame_map(map_output_path, frame_map)
+
+def main(input_dir, par_th = 0.95, max_frame = 18000, stream_copy = False):
+    """
+    Extract the segments seen from the top of every lane, see extract_lane.
+    """
     print('start to read : '+input_dir)
-    roi_file = input_dir + '/ROI_frame_splits.txt'
-    orient_file = input_dir + '/corrected_orient.txt'
-
-    path, folder = os.path.split(input_dir)
-    if folder == 'analysis_output':
-        path, folder = os.path.split(path)
-
-    roi_list = list(csv.reader(open(roi_file, 'rt'), delimiter='\t'))
-    orient_list = list(csv.reader(open(orient_file, 'rt'), delimiter='\t'))
-
-    cap = None
-    img_path = []
-    img_lane = []
-    side_name = []
-    frame_info = []
-    top_frames = []
-    max_lane = -1
-    for k in range(len(roi_list)):
-        roi = int(roi_list[k][0])
-        fstart = int(roi_list[k][1])
-        fend = int(roi_list[k][2])
-        lane_id = int(roi_list[k][3])
-        new_lane = False
-
-        # bug??
-        if fstart==0 and fend==0:
-            continue;
-
-        #if roi==1 or roi==4:
-        #    continue
-
-        bottom_count = 0;
-        for i in range(fstart, fend):
-            if orient_list[i][lane_id] == '0':
-                bottom_count = bottom_count + 1
-        
-        bottom_late = float(bottom_count) / (fend-fstart)
-
-        side = 'top'
-        if bottom_late < par_th:
-            side = 'bad'
-
-        if max_lane < lane_id:
-            max_lane = lane_id
-            new_lane = True
-
-        print('process lane='+str(lane_id)+' fstart='+str(fstart)+' fend='+str(fend)+' rate='+str(bottom_late))
-
-        if new_lane:
-            if cap is not None:
-                cap.release()
-                cap = None
-                frame_info.append(top_frames)
-
-            # open avi
-            cap = cv2.VideoCapture(input_dir+'/lane_'+str(lane_id)+'.avi')
-
-            # make temporary frames
-            top_path = 'tmp_'+folder+'_lane_'+str(lane_id)+'_top'
-#            bad_path = 'tmp_'+folder+'_lane_'+str(lane_id)+'_bad'
-            img_path.append(top_path)
-#            img_path.append(bad_path)
-            img_lane.append(lane_id)
-#            img_lane.append(lane_id)
-            side_name.append('top')
-#            side_name.append('bad')
-            if not os.path.exists(top_path):
-                os.makedirs(top_path)
-#            if not os.path.exists(bad_path):
-#                os.makedirs(bad_path)
-            tCount = 0
-#            sCount = 0
-            top_frames = []
-
-#        continue
-
-        tmp_path = 'tmp_'+folder+'_lane_'+str(lane_id)+'_'+side
-        for i in range(fstart, fend):
-            #Store this frame to an image
-            if bottom_late >= par_th:
-                cap.set(1,i);
-                ret, frame = cap.read()
-                io.imsave(f'{tmp_path}/ext_{tCount}.tif', frame)
-                tCount = tCount+1
-                crr_frame = [i,roi]
-                top_frames.append(crr_frame)
-                
-#            else:
-#                cap.set(1,i);
-#                ret, frame = cap.read()
-#                io.imsave(f'{tmp_path}/ext_{sCount}.tif', frame)
-#                sCount = sCount+1
-
-    # release object
-    if cap is not None:
-        cap.release()
-        cap = None
-        frame_info.append(top_frames)
-
-    for i in range(len(img_path)):
-        lane_id = img_lane[i]
-        tmp_path = img_path[i]
-        sname = side_name[i]
-        csvdata = frame_info[i]
-        video_output_path = os.path.join(input_dir, 'lane_'+str(lane_id)+'_'+sname+'byroi.avi')
-        print('generage movie : '+video_output_path)
-        call(['ffmpeg', '-y', '-i', f'{tmp_path}/ext_%d.tif', video_output_path])
-        time.sleep(3)
-        
-        csv_output_path = os.path.join(input_dir, 'lane_'+str(lane_id)+'_'+sname+'byroi.txt')
-        with open(csv_output_path, "wt") as csv_file:
-            writer = csv.writer(csv_file, delimiter='\t')
-            for line in csvdata:
-                writer.writerow(line)
-
-        shutil.rmtree(tmp_path)
-        time.sleep(3)
+    roi_list, top = load_top_segments(input_dir, par_th)
+    for lane_id in np.unique(roi_list[:, 3]):
+        extract_lane(input_dir, int(lane_id), par_th, stream_copy, roi_list, top)
+
+def batch(exp_dir, workers=0, par_th=0.95, stream_copy=False, num_slots=4, reverse=False):
+    """
+    Extract the lanes of all experiments in exp_dir that have a
+    corrected_orient table but no lane_N_topbyroi.txt yet. Every
+    (experiment, lane) pair is a task of a process pool. Exits
+    with status 1 if any lane failed.
+
+    Parameters
+    ----------
+    exp_dir : string
+        Directory containing one directory per experiment.
+    workers : int, default=0
+        Number of worker processes. If 0, the number of cores.
+    par_th, stream_copy :
+        See extract_lane.
+    num_slots : int, default=4
+        Number of lanes.
+    reverse : bool, default=False
+        Queue the experiments in reverse order.
+    """
+    tasks = [(input_dir, lane_id, par_th, stream_copy)
+             for input_dir in find_experiments(exp_dir, reverse)
+             for lane_id in range(num_slots)
+             if not os.path.exists(os.path.join(input_dir, f'lane_{lane_id}_topbyroi.txt'))]
+    failed = run_tasks(extract_lane, tasks, workers)
+    if failed:
+        raise SystemExit(f'{len(failed)} lanes failed')
 
 
 if __name__ == '__main__':
-    argh.dispatch_command(main)
+    dispatch(main, [batch])
@@ -0,0 +1,84 @@
+#! /anaconda3/bin/python
+
+import os.path
+from lane_store import open_lane, route_frames
+from frame_tables import load_table
+from lane_pool import find_experiments, write_frame_map, run_tasks
+from extract_avi import select_frames
+from extract_avi_byROI import load_top_segments, select_segments
+from cli import dispatch
+
+def extract_lane(input_dir, lane_id, par_th=0.95):
+    """
+    Write lane_N_top.avi with lane_N_top.txt (frames selected by
+    extract_avi.select_frames) and lane_N_topbyroi.avi with
+    lane_N_topbyroi.txt (segments selected by
+    extract_avi_byROI.select_segments) of a lane, decoding lane_N.avi once.
+    The outputs are the same as those of the two scripts.
+
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory of an experiment.
+    lane_id : int
+        Lane number.
+    par_th : float, default=0.95
+        Minimal fraction of frames seen from the top in a segment.
+    """
+    print('start to process lane :'+str(lane_id))
+    roi_list = load_table(input_dir, 'corrected_ROIs')
+    orient_list = load_table(input_dir, 'corrected_orient')
+    segment_list, top = load_top_segments(input_dir, par_th)
+    top_map = select_frames(roi_list, orient_list, lane_id)
+    segments, frame_map = select_segments(segment_list, top, lane_id)
+
+    selections = [(top_map[:, 0], os.path.join(input_dir, f'lane_{lane_id}_top.avi')),
+                  (frame_map[:, 0], os.path.join(input_dir, f'lane_{lane_id}_topbyroi.avi'))]
+    cap = open_lane(input_dir, lane_id)
+    counts = route_frames(cap, selections)
+    cap.release()
+    for (frames, path), count in zip(selections, counts):
+        print(f'{path}: {count} frames')
+    # the frame maps mark the lane as done, so they are written last
+    write_frame_map(os.path.join(input_dir, f'lane_{lane_id}_top.txt'), top_map)
+    write_frame_map(os.path.join(input_dir, f'lane_{lane_id}_topbyroi.txt'), frame_map)
+
+def main(input_dir, par_th=0.95, num_slots=4):
+    """
+    Extract both products of every lane of an experiment, see extract_lane.
+    """
+    print('start to read : '+input_dir)
+    for lane_id in range(num_slots):
+        extract_lane(input_dir, lane_id, par_th)
+
+def batch(exp_dir, workers=0, par_th=0.95, num_slots=4, reverse=False):
+    """
+    Extract both products of the lanes of all experiments in exp_dir that
+    have a corrected_orient table but no lane_N_topbyroi.txt yet. Every
+    (experiment, lane) pair is a task of a process pool. Exits
+    with status 1 if any lane failed.
+
+    Parameters
+    ----------
+    exp_dir : string
+        Directory containing one directory per experiment.
+    workers : int, default=0
+        Number of worker processes. If 0, the number of cores.
+    par_th : float, default=0.95
+        See extract_lane.
+    num_slots : int, default=4
+        Number of lanes.
+    reverse : bool, default=False
+        Queue the experiments in reverse order.
+    """
+    tasks = [(input_dir, lane_id, par_th)
+             for input_dir in find_experiments(exp_dir, reverse)
+             for lane_id in range(num_slots)
+             if not os.path.exists(os.path.join(input_dir, f'lane_{lane_id}_topbyroi.txt'))]
+    failed = run_tasks(extract_lane, tasks, workers)
+    if failed:
+        raise SystemExit(f'{len(failed)} lanes failed')
+
+
+if __name__ == '__main__':
+    dispatch(main, [batch])
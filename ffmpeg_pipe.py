@@ -0,0 +1,92 @@
+import subprocess
+import numpy as np
+
+# ffmpeg raw pixel formats for (dtype, number of channels)
+PIX_FMTS = {
+    (np.dtype(np.uint8), 1): 'gray',
+    (np.dtype(np.uint16), 1): 'gray16le',
+    (np.dtype(np.uint8), 3): 'bgr24',
+}
+
+
+class ffmpeg_writer(object):
+    """
+    Encode raw frames by streaming them into the stdin of an ffmpeg process.
+    No intermediate image files are written.
+    """
+
+    def __init__(self, output_path, frame_shape, dtype, fps=25, extra_args=()):
+        """
+        Start ffmpeg.
+
+        Parameters
+        ----------
+        output_path : string
+            Path of the video file to write.
+        frame_shape : tuple
+            (rows, columns) for grayscale or (rows, columns, 3) for BGR frames.
+        dtype : np.dtype
+            Data type of the frames, uint8 or uint16.
+        fps : float, default=25
+            Frame rate of the output video. ffmpeg uses 25 for image sequences.
+        extra_args : sequence of strings, optional
+            Additional output options passed to ffmpeg.
+        """
+        self.output_path = output_path
+        self.frame_shape = tuple(frame_shape)
+        channels = self.frame_shape[2] if len(self.frame_shape) == 3 else 1
+        self.dtype = np.dtype(dtype).newbyteorder('=')
+        pix_fmt = PIX_FMTS[(self.dtype, channels)]
+        size = f'{self.frame_shape[1]}x{self.frame_shape[0]}'
+        self.n_frames = 0
+        self.broken = False
+        self.proc = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                                      '-f', 'rawvideo', '-pix_fmt', pix_fmt,
+                                      '-s', size, '-framerate', str(fps),
+                                      '-i', '-'] + list(extra_args) + [output_path],
+                                     stdin=subprocess.PIPE)
+
+    def write(self, frames):
+        """
+        Append frames to the video.
+
+        Parameters
+        ----------
+        frames : np.array
+            One frame or a block of frames with shape (n,) + frame_shape.
+        """
+        frames = np.asarray(frames)
+        if frames.shape == self.frame_shape:
+            frames = frames[np.newaxis]
+        assert frames.shape[1:] == self.frame_shape, 'frame shape mismatch'
+        if self.broken:
+            return
+        try:
+            frames = np.ascontiguousarray(frames, dtype=self.dtype.newbyteorder('<'))
+            self.proc.stdin.write(memoryview(frames).cast('B'))
+        except BrokenPipeError:
+            # ffmpeg exited early, the error is reported by close
+            self.broken = True
+        self.n_frames += len(frames)
+
+    def close(self):
+        """
+        Finish encoding and wait for ffmpeg.
+
+        Returns
+        -------
+        int
+            Exit status of ffmpeg.
+        """
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            self.broken = True
+        return self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.proc.returncode is None:
+            self.close()
@@ -0,0 +1,108 @@
+#! /anaconda3/bin/python
+
+import os
+import os.path
+import argh
+import numpy as np
+
+# Tables written by ROI_track.py and check_orient.py
+TABLE_NAMES = ['nominal_ROIs', 'corrected_ROIs', 'ROI_frame_splits', 'corrected_orient']
+TABLE_FORMATS = ['txt', 'npy', 'both']
+
+def table_dtype(data):
+    """
+    Smallest signed integer type that holds all entries of data. The per-frame
+    ROI and orientation tables fit in int8, frame numbers need more.
+    """
+    data = np.asarray(data)
+    if data.size == 0:
+        return np.dtype(np.int8)
+    for dtype in [np.int8, np.int16, np.int32]:
+        info = np.iinfo(dtype)
+        if info.min <= data.min() and data.max() <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+def save_table(out_dir, name, data, table_format='txt'):
+    """
+    Save an integer table as name.txt (tab separated, as the pipeline always
+    wrote it), as name.npy or as both.
+
+    Parameters
+    ----------
+    out_dir : string
+        Directory where the table is stored.
+    name : string
+        Table name without extension, e.g. 'corrected_ROIs'.
+    data : 2D np.array
+        Table with one row per frame (or per segment).
+    table_format : {'txt', 'npy', 'both'}, default='txt'
+        Output format. The .npy file holds the smallest integer type that
+        fits the table, int8 for ROIs and orientation flags.
+    """
+    assert table_format in TABLE_FORMATS, f'unknown table format {table_format}'
+    data = np.asarray(data)
+    if table_format in ['txt', 'both']:
+        np.savetxt(os.path.join(out_dir, name + '.txt'), data, fmt='%d', delimiter='\t')
+    if table_format in ['npy', 'both']:
+        np.save(os.path.join(out_dir, name + '.npy'), data.astype(table_dtype(data)))
+
+def table_exists(in_dir, name):
+    """
+    True if the table was written in any format.
+    """
+    return any(os.path.exists(os.path.join(in_dir, f'{name}.{ext}')) for ext in ['npy', 'txt'])
+
+def load_table(in_dir, name, mmap_mode=None):
+    """
+    Load an integer table written by save_table, or a text table written by
+    earlier versions of the pipeline or by check_orient.m. The .npy file is
+    used unless the .txt file is newer.
+
+    Parameters
+    ----------
+    in_dir : string
+        Directory of the table.
+    name : string
+        Table name without extension, e.g. 'corrected_ROIs'.
+    mmap_mode : {None, 'r'}, default=None
+        Memory-map the .npy file instead of reading it.
+
+    Returns
+    -------
+    2D np.array of int
+        Table with one row per frame (or per segment).
+    """
+    npy_path = os.path.join(in_dir, name + '.npy')
+    txt_path = os.path.join(in_dir, name + '.txt')
+    if os.path.exists(npy_path) and \
+            (not os.path.exists(txt_path) or os.path.getmtime(npy_path) >= os.path.getmtime(txt_path)):
+        return np.load(npy_path, mmap_mode=mmap_mode)
+    return np.loadtxt(txt_path, dtype=int, ndmin=2)
+
+def main(exp_dir):
+    """
+    Write name.npy next to every text table in exp_dir and its
+    subdirectories that has no up to date binary copy.
+
+    Parameters
+    ----------
+    exp_dir : string
+        Root directory of the experiments, e.g. a genotype sweep.
+    """
+    count = 0
+    for root, dirs, files in os.walk(exp_dir):
+        for name in TABLE_NAMES:
+            if name + '.txt' not in files:
+                continue
+            npy_path = os.path.join(root, name + '.npy')
+            if os.path.exists(npy_path) and \
+                    os.path.getmtime(npy_path) >= os.path.getmtime(os.path.join(root, name + '.txt')):
+                continue
+            save_table(root, name, load_table(root, name), 'npy')
+            count += 1
+    print(f'converted {count} tables')
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
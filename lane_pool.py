@@ -0,0 +1,106 @@
+import os
+import os.path
+import csv
+import time
+import socket
+import multiprocessing
+from frame_tables import table_exists
+
+def find_experiments(exp_dir, reverse=False):
+    """
+    Find the analysis_output directories in exp_dir that have a
+    corrected_orient table, i.e. are ready for extraction.
+
+    Parameters
+    ----------
+    exp_dir : string
+        Directory containing one directory per experiment.
+    reverse : bool, default=False
+        Return the directories in reverse order.
+
+    Returns
+    -------
+    list of strings
+        analysis_output directories.
+    """
+    dirs = sorted(next(os.walk(exp_dir))[1], reverse=reverse)
+    dirs = [os.path.join(exp_dir, d, 'analysis_output') for d in dirs]
+    return [d for d in dirs if table_exists(d, 'corrected_orient')]
+
+def temp_output(output_path):
+    """
+    Temporary path of an output, next to it and with the same extension.
+    Host name and process id are part of the name, so batch runs on several
+    machines (see --reverse) never write to the same temporary file.
+    """
+    root, ext = os.path.splitext(output_path)
+    return f'{root}.{socket.gethostname()}_{os.getpid()}.tmp{ext}'
+
+def replace_output(tmp_path, output_path):
+    """
+    Move the output of a task to its final path, so that an interrupted task
+    never leaves a complete looking file behind.
+    """
+    if os.path.exists(tmp_path):
+        os.replace(tmp_path, output_path)
+
+def write_frame_map(output_path, frame_map):
+    """
+    Write the tab separated frame map of an extracted video, e.g. frame
+    number and ROI of every frame of lane_N_top.avi. The map is written
+    after the video and marks the lane as done, so a lane without any
+    selected frame is not extracted again.
+    """
+    tmp_path = temp_output(output_path)
+    with open(tmp_path, 'wt') as csv_file:
+        writer = csv.writer(csv_file, delimiter='\t')
+        writer.writerows(frame_map)
+    replace_output(tmp_path, output_path)
+
+def _run_task(task):
+    """
+    Pool worker for run_tasks; returns the task, time and error if any.
+    """
+    function, args = task
+    start = time.time()
+    try:
+        function(*args)
+        return args, time.time() - start, None
+    except Exception as e:
+        return args, time.time() - start, repr(e)
+
+def run_tasks(function, tasks, workers=0):
+    """
+    Run function(*args) for every args in tasks in a process pool. Each task
+    handles one (experiment, lane) pair and writes only its own files, so a
+    failing task does not affect the others.
+
+    Parameters
+    ----------
+    function : callable
+        Module level function, e.g. extract_avi.extract_lane.
+    tasks : list of tuples
+        Arguments of each call; the first two are directory and lane.
+    workers : int, default=0
+        Number of worker processes. If 0, the number of cores.
+
+    Returns
+    -------
+    list of tuples
+        Arguments of the failed tasks.
+    """
+    print(f'{len(tasks)} lanes to process')
+    if len(tasks) == 0:
+        return []
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+    start = time.time()
+    results = []
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        for args, elapsed, error in pool.imap_unordered(_run_task, [(function, args) for args in tasks]):
+            results.append((args, elapsed, error))
+            print(f'{args[0]} lane {args[1]}: ' + (error if error else f'{elapsed:.2f} s'))
+
+    failed = [args for args, elapsed, error in results if error]
+    print(f'{len(results)} lanes in {time.time() - start:.2f} s ({len(failed)} failed)')
+    return failed
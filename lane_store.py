@@ -0,0 +1,267 @@
+import os
+import os.path
+import numpy as np
+import cv2
+from ffmpeg_pipe import ffmpeg_writer
+from lane_pool import temp_output
+
+
+class lane_store_writer(object):
+    """
+    Write the frames of one lane into a memory-mapped .npy file of shape
+    (frames, rows, columns). Unlike a compressed video, every frame can be
+    read back in constant time. The store is written under a temporary
+    name and only replaces output_path when all frames were written.
+    Has the same write/close interface as ffmpeg_pipe.ffmpeg_writer.
+    """
+
+    def __init__(self, output_path, frame_shape, dtype, n_frames):
+        """
+        Create the store.
+
+        Parameters
+        ----------
+        output_path : string
+            Path of the .npy file to write.
+        frame_shape : tuple
+            (rows, columns) of a frame.
+        dtype : np.dtype
+            Data type of the frames.
+        n_frames : int
+            Number of frames in the lane.
+        """
+        self.output_path = output_path
+        self.tmp_path = temp_output(output_path)
+        self.frame_shape = tuple(frame_shape)
+        self.data = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=dtype,
+                                              shape=(n_frames,) + self.frame_shape)
+        self.n_frames = 0
+
+    def write(self, frames):
+        """
+        Append frames to the store.
+
+        Parameters
+        ----------
+        frames : np.array
+            One frame or a block of frames with shape (n,) + frame_shape.
+        """
+        frames = np.asarray(frames)
+        if frames.shape == self.frame_shape:
+            frames = frames[np.newaxis]
+        self.data[self.n_frames:self.n_frames + len(frames)] = frames
+        self.n_frames += len(frames)
+
+    def close(self):
+        """
+        Flush the store to disk and move it to output_path. An incomplete
+        store is removed.
+
+        Returns
+        -------
+        int
+            0 if all frames were written, 1 otherwise.
+        """
+        self.data.flush()
+        complete = self.n_frames == len(self.data)
+        del self.data
+        if not complete:
+            os.remove(self.tmp_path)
+            return 1
+        os.replace(self.tmp_path, self.output_path)
+        return 0
+
+    def abort(self):
+        """
+        Remove the store after an error; output_path is left as it is.
+        """
+        del self.data
+        os.remove(self.tmp_path)
+
+
+class lane_reader(object):
+    """
+    Random access reader for a lane store written by lane_store_writer.
+    Implements the parts of the cv2.VideoCapture interface used by the
+    extraction scripts, so it can be used in place of it.
+    """
+
+    def __init__(self, path, as_bgr=True):
+        """
+        Open the store.
+
+        Parameters
+        ----------
+        path : string
+            Path of the .npy file.
+        as_bgr : bool, default=True
+            If True, frames are returned as 8-bit BGR images like
+            cv2.VideoCapture returns them for the lane avi files.
+            Otherwise the raw frames are returned.
+        """
+        self.path = path
+        self.data = np.load(path, mmap_mode='r')
+        self.as_bgr = as_bgr
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        """
+        Return one frame or a range of frames without decoding any other frame.
+        """
+        frames = self.data[key]
+        if not self.as_bgr:
+            return frames
+        if frames.dtype == np.uint16:
+            frames = (frames >> 8).astype(np.uint8)
+        return np.repeat(frames[..., np.newaxis], 3, axis=-1)
+
+    def isOpened(self):
+        return self.data is not None
+
+    def get(self, prop_id):
+        if prop_id == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.data))
+        if prop_id == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.pos)
+        if prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.data.shape[1])
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.data.shape[2])
+        return 0.
+
+    def set(self, prop_id, value):
+        if prop_id != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.pos = int(value)
+        return True
+
+    def read(self):
+        if self.data is None or not 0 <= self.pos < len(self.data):
+            return False, None
+        frame = self[self.pos]
+        self.pos += 1
+        return True, frame
+
+    def release(self):
+        self.data = None
+
+
+def open_lane(input_dir, lane_id, lane_format=None):
+    """
+    Open the frames of a lane.
+
+    Parameters
+    ----------
+    input_dir : string
+        analysis_output directory of an experiment.
+    lane_id : int
+        Lane number.
+    lane_format : {None, 'avi', 'npy'}, default=None
+        Open lane_N.avi or lane_N.npy. If None, the more recently written
+        of the two is opened, so a lane store left over from an earlier
+        run does not shadow a newer avi.
+
+    Returns
+    -------
+    lane_reader or cv2.VideoCapture
+        Reader for lane_N.npy or capture of lane_N.avi.
+    """
+    assert lane_format in (None, 'avi', 'npy'), f'unknown lane_format {lane_format}'
+    store_path = os.path.join(input_dir, f'lane_{lane_id}.npy')
+    video_path = os.path.join(input_dir, f'lane_{lane_id}.avi')
+    if lane_format is None:
+        use_store = os.path.exists(store_path) and \
+            (not os.path.exists(video_path) or
+             os.path.getmtime(store_path) >= os.path.getmtime(video_path))
+        lane_format = 'npy' if use_store else 'avi'
+    if lane_format == 'npy':
+        return lane_reader(store_path)
+    return cv2.VideoCapture(video_path)
+
+
+def read_frames(cap, indices):
+    """
+    Read the frames with the given sorted indices. Lane stores are indexed
+    directly. Videos are decoded once from the current position; frames in
+    between are only grabbed, so no frame is decoded twice and no seek is
+    needed. A frame that cannot be read raises an AssertionError, so
+    callers never write frame lists for frames that are not in the video.
+
+    Parameters
+    ----------
+    cap : lane_reader or cv2.VideoCapture
+        Opened lane, see open_lane.
+    indices : 1D np.array of int
+        Sorted frame indices.
+
+    Yields
+    ------
+    np.array
+        Frame as returned by cap.read.
+    """
+    if isinstance(cap, lane_reader):
+        for i in indices:
+            yield cap[int(i)]
+        return
+    pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    for i in indices:
+        while pos < i:
+            assert cap.grab(), f'could not read frame {pos}'
+            pos += 1
+        ret, frame = cap.read()
+        assert ret, f'could not read frame {pos}'
+        pos += 1
+        yield frame
+
+
+def route_frames(cap, selections):
+    """
+    Decode the frames of a lane once and stream every frame into each video
+    whose selection contains it. Videos are written under a temporary name
+    and renamed when complete; ffmpeg is started with the first frame of a
+    video, so no video is written for an empty selection.
+
+    Parameters
+    ----------
+    cap : lane_reader or cv2.VideoCapture
+        Opened lane, see open_lane.
+    selections : list of (1D np.array of int, string)
+        Sorted frame indices and output path of each video.
+
+    Returns
+    -------
+    list of int
+        Number of frames written to each video.
+    """
+    frames = np.unique(np.concatenate([np.asarray(f, dtype=np.int64) for f, path in selections]))
+    member = np.zeros((len(selections), len(frames)), dtype=bool)
+    for k, (f, path) in enumerate(selections):
+        member[k] = np.isin(frames, f)
+    tmp_paths = [temp_output(path) for f, path in selections]
+    writers = [None] * len(selections)
+    try:
+        for j, frame in enumerate(read_frames(cap, frames)):
+            # lanes are gray; piping one channel is smaller and avoids a lossy
+            # BGR to YUV conversion in ffmpeg
+            frame = frame[..., 0]
+            for k in np.flatnonzero(member[:, j]):
+                if writers[k] is None:
+                    writers[k] = ffmpeg_writer(tmp_paths[k], frame.shape, frame.dtype)
+                writers[k].write(frame)
+    except BaseException:
+        # keep the original error; ffmpeg may not have created its output
+        for writer, tmp_path in zip(writers, tmp_paths):
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    for (f, path), writer, tmp_path in zip(selections, writers, tmp_paths):
+        if writer is not None:
+            assert writer.close() == 0, 'ffmpeg failed to write ' + path
+            os.replace(tmp_path, path)
+    return [0 if writer is None else writer.n_frames for writer in writers]
@@ -0,0 +1,172 @@
+#! /anaconda3/bin/python
+
+import os.path
+import csv
+import json
+import time
+import argh
+import numpy as np
+from virtual_stack import open_mmstack
+from step_1 import (quick_calibrate, find_lanes, wall_positions, laser_positions,
+                    open_lane_writers, abort_lane_writers, close_lane_writers, lane_feeder)
+from centroid_tracker import background_images, track_chunk, fill_tracks, save_tracks
+from check_orient import near_edge, side_view_flags, duration_filter, gap_filter
+from ROI_track import classify_ROIs
+from frame_tables import save_table
+
+def orient_chunk(lane, background_8bit, x, y, angle, y_th=35, box_size=80, side_th=15):
+    """
+    Orientation check of a chunk of one lane, see check_orient.check_lane.
+    Only frames with the fly near the top or bottom edge are checked;
+    frames without a track are not.
+
+    Parameters
+    ----------
+    lane : 3D np.array of type uint16
+        Frames of the lane with shape (frames, rows, columns).
+    background_8bit : 2D np.array
+        8-bit background image of the lane.
+    x, y, angle : 1D np.arrays
+        Track of the chunk from centroid_tracker.track_chunk.
+    y_th, box_size, side_th :
+        Parameters of the orientation check, see check_orient.main.
+
+    Returns
+    -------
+    1D np.array of int
+        1 for frames with the fly seen from the side.
+    """
+    height = lane.shape[1]
+    flags = np.zeros(len(lane), dtype=int)
+    candidates = near_edge(x, y, height, y_th) & np.isfinite(angle)
+    if np.any(candidates):
+        images = (lane[candidates] >> 8).astype(np.uint8)
+        flags[candidates] = side_view_flags(images, background_8bit, x[candidates],
+                                            height - y[candidates], angle[candidates],
+                                            box_size, side_th)
+    return flags
+
+def main(path_tif, path_laser_position, output_dir, chunk_size=200, lane_format='avi',
+         thresh=8000, y_th=35, box_size=80, side_th=15, gap=30, duration=10,
+         mm_per_px=3./106, ROI_width=3.5, fps=60, min_ROI_sec=0.25, table_format='txt'):
+    """
+    Fused pipeline that runs step 1 to step 4 (lane split, centroid tracking,
+    orientation and ROI classification) with a single read of the recording.
+    Lanes are estimated from a sample of frames (see step_1.quick_calibrate)
+    and the background from the frames sampled by centroid_tracker. Each
+    chunk of the recording is then read once and goes through lane slicing,
+    encoding, tracking and the orientation check. Walls are taken from the
+    mean image of that pass, and all outputs are written at the end.
+    All outputs are cut with the sampled lanes. The lanes found in the
+    occupancy of the full pass are compared with them; a mismatch is
+    reported and recorded in calibration.json, together with the sampling
+    statistics, but the outputs are kept, since they are consistent with
+    lanes.csv. Run step_1.py on such a recording to cut it with the lanes
+    of the full pass.
+
+    Parameters
+    ----------
+    path_tif : string
+        Path to tif stack with video frames.
+    path_laser_position : string
+        Path to image with laser position.
+    output_dir : string
+        Directory where output is stored.
+    chunk_size : int, default=200
+        Number of frames held in memory at a time.
+    lane_format : {'avi', 'npy', 'both'}, default='avi'
+        Write lossy lane videos, memory-mapped lane stores or both.
+    thresh : float, default=8000
+        Minimal absolute difference to the background of a fly pixel.
+    y_th, box_size, side_th, gap, duration :
+        Parameters of the orientation check, see check_orient.main.
+    mm_per_px, ROI_width, fps, min_ROI_sec :
+        Parameters of the ROI classification, see ROI_track.main.
+    table_format : {'txt', 'npy', 'both'}, default='txt'
+        Format of the ROI and orientation tables, see frame_tables.save_table.
+    """
+    print('start to read : '+path_tif)
+    video = open_mmstack(path_tif)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    lanes, position, calibration = quick_calibrate(video)
+    num_slots = len(lanes) // 2
+    backgrounds = background_images(video, lanes)
+    # orientation check works on 8-bit frames like the decoded lane videos
+    backgrounds_8bit = [np.clip(np.round(b / 256.), 0, 255) for b in backgrounds]
+
+    thresh_count = np.zeros(video.shape[1:], dtype=np.uint32)
+    pixel_sum = np.zeros(video.shape[1:], dtype=np.uint64)
+    tracks = np.empty((len(video), num_slots, 3), dtype=np.float32)
+    orient = np.zeros((len(video), num_slots), dtype=int)
+
+    start_time = time.time()
+    writers = open_lane_writers(video, lanes, output_dir, range(num_slots), lane_format)
+    try:
+        feeder = lane_feeder(writers, lanes)
+        try:
+            for start, chunk in video.iter_chunks(chunk_size):
+                stop = start + len(chunk)
+                feeder.write(chunk)
+                thresh_count += np.count_nonzero(chunk > 28000, axis=0).astype(np.uint32)
+                pixel_sum += np.sum(chunk, axis=0, dtype=np.uint64)
+                for lane_id in range(num_slots):
+                    lane = chunk[:, lanes[2*lane_id]:lanes[2*lane_id+1], :]
+                    x, y, angle = track_chunk(lane, backgrounds[lane_id], thresh)
+                    tracks[start:stop, lane_id] = np.stack((x, y, angle), axis=1)
+                    orient[start:stop, lane_id] = orient_chunk(
+                        lane, backgrounds_8bit[lane_id], x, y, angle, y_th, box_size, side_th)
+                print(f'{stop} frames, {stop / (time.time() - start_time):.1f} frames/s')
+        except BaseException:
+            feeder.stop()
+            raise
+        feeder.finish()
+    except BaseException:
+        abort_lane_writers(writers)
+        raise
+    failed = close_lane_writers(writers)
+    if failed:
+        raise RuntimeError(f'failed to write {failed}')
+
+    # Lanes from the occupancy of the full pass. The outputs were cut with
+    # the sampled lanes and stay consistent with lanes.csv, so a mismatch
+    # is only reported.
+    full_lanes = find_lanes(thresh_count)
+    calibration['lanes'] = lanes
+    calibration['full_lanes'] = full_lanes
+    if full_lanes != lanes:
+        print(f'warning: lanes of the full recording {full_lanes} differ from the sampled '
+              f'lanes {lanes}, run step_1.py on this recording to cut it with the full lanes')
+    with open(os.path.join(output_dir, 'calibration.json'), 'w') as fp:
+        json.dump(calibration, fp, sort_keys=True, indent=4)
+    position = wall_positions(pixel_sum / len(video), lanes)
+    path_laser_position = os.path.expanduser(os.path.expandvars(path_laser_position))
+    for i, laser in enumerate(laser_positions(path_laser_position, lanes)):
+        position[f'slot_{i}']['laser'] = laser
+    with open(os.path.join(output_dir, 'lanes.csv'), 'w') as fp:
+        wr = csv.writer(fp, quoting=csv.QUOTE_ALL)
+        wr.writerow(lanes)
+    with open(os.path.join(output_dir, 'position.json'), 'w') as fp:
+        json.dump(position, fp, sort_keys=True, indent=4)
+
+    # Tracks
+    save_tracks(output_dir, tracks, backgrounds)
+
+    # Orientation
+    for lane_id in range(num_slots):
+        orient[:, lane_id] = gap_filter(duration_filter(orient[:, lane_id], duration), gap)
+    save_table(output_dir, 'corrected_orient', orient, table_format)
+
+    # ROIs
+    a = classify_ROIs(mm_per_px, ROI_width, fps, min_ROI_sec, num_slots)
+    a.load_laser_wall_pos(output_dir)
+    a.set_centroid_data(fill_tracks(tracks[:, :, :1])[:, :, 0])
+    a.ROI_nominal()
+    a.ROI_corrected()
+    a.get_ROI_splits()
+    a.save_data(output_dir, table_format)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,89 @@
+import numpy as np
+
+# edge handling of box_smooth and the np.pad mode that implements it
+EDGE_MODES = {'wrap': 'wrap', 'nearest': 'edge', 'reflect': 'symmetric', 'constant': 'constant'}
+
+def box_window(fps, window_T):
+    """
+    Number of frames of the box filter used by the analysis scripts: all
+    frames within window_T seconds before and after a frame.
+    """
+    return 2 * int(1. * fps * window_T)
+
+def box_smooth(data, window, axis=0, mode='wrap'):
+    """
+    Box average of one trace or of a batch of traces (e.g. all DLC body part
+    columns), computed from cumulative sums in O(n) time independent of the
+    window length.
+
+    The window of sample i holds samples i - (window-1)//2 to i + window//2,
+    so an even window reaches one sample further ahead than back, as the
+    roll-based smoothers did. Windows holding a nan or inf give nan.
+
+    Parameters
+    ----------
+    data : np.array
+        Trace(s) to smooth.
+    window : int
+        Number of samples averaged; 0 returns a copy of data.
+    axis : int, default=0
+        Time axis of data.
+    mode : {'wrap', 'nearest', 'reflect', 'constant', 'shrink'}, default='wrap'
+        Samples used beyond the ends of a trace: the other end of the trace
+        (as sp.roll), the first or last sample, the trace mirrored at its
+        ends, zeros, or none, i.e. the window shrinks at the ends.
+
+    Returns
+    -------
+    np.array of type float64
+        Smoothed traces with the shape of data.
+    """
+    assert mode in EDGE_MODES or mode == 'shrink', f'unknown edge mode {mode}'
+    data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, 0)
+    n = len(data)
+    if window < 1 or n == 0:
+        return np.moveaxis(data.copy(), 0, axis)
+    before, after = (window - 1) // 2, window // 2
+
+    if mode == 'shrink':
+        padded = data
+    else:
+        pad = [(before, after)] + [(0, 0)] * (data.ndim - 1)
+        padded = np.pad(data, pad, mode=EDGE_MODES[mode])
+
+    # running sums relative to the first sample of each trace, which keeps
+    # the sums small for traces far from zero; nan and inf are counted
+    # separately so they only affect their own windows
+    bad = ~np.isfinite(padded)
+    any_bad = bad.any()
+    offset = np.where(bad[0], 0, padded[0])
+    values = np.where(bad, 0, padded - offset) if any_bad else padded - offset
+    sums = np.zeros((len(padded) + 1,) + padded.shape[1:])
+    np.cumsum(values, axis=0, out=sums[1:])
+
+    if mode == 'shrink':
+        idx = np.arange(n)
+        lo = np.maximum(idx - before, 0)
+        hi = np.minimum(idx + after + 1, n)
+        counts = (hi - lo).reshape((n,) + (1,) * (data.ndim - 1))
+    else:
+        lo = slice(0, n)
+        hi = slice(window, window + n)
+        counts = window
+    smoothed = (sums[hi] - sums[lo]) / counts + offset
+    if any_bad:
+        bad_counts = np.zeros(sums.shape, dtype=np.int64)
+        np.cumsum(bad, axis=0, out=bad_counts[1:])
+        smoothed[bad_counts[hi] > bad_counts[lo]] = np.nan
+    return np.moveaxis(smoothed, 0, axis)
+
+def box_smooth_loop(arr, window):
+    """
+    Reference box average of a 1D trace by summing rolled copies of the
+    trace, as the analysis scripts did before box_smooth.
+    """
+    smoothed = np.zeros(len(arr))
+    offsets = np.arange(-(window // 2), window - window // 2)
+    for offset in offsets:
+        smoothed += np.roll(arr, offset)
+    return smoothed / len(offsets)
@@ -0,0 +1,9 @@
+SET EXPDIR="d:\Fly videos\Experiment"
+
+for /f "tokens=*" %%G in ('dir /b /a:d %EXPDIR%\*') do (
+    if exist %EXPDIR%\%%G\analysis_output\position.json (
+        if not exist %EXPDIR%\%%G\analysis_output\tracks.npy (
+            python centroid_tracker.py %EXPDIR%\%%G\%%G_MMStack_Pos0.ome.tif %EXPDIR%\%%G\analysis_output
+        )
+    )
+)
@@ -0,0 +1,3 @@
+SET EXPDIR="d:\Fly videos\Experiment"
+
+python extract_avi_combined.py batch %EXPDIR%
@@ -1,22 +1,68 @@
 #! /anaconda3/bin/python
 
 import os.path
-import shutil
-from subprocess import call
 import numpy as np
 import cv2
 from skimage import io
 import json
 import csv
 import argh
-import datetime
 import time
+import queue
+import threading
+from virtual_stack import open_mmstack
+from ffmpeg_pipe import ffmpeg_writer
+from lane_store import lane_store_writer
 
 def hysteresis_filter(seq, n=5, n_false=None):
     """
     This function implements a hysteresis filter for boolean sequences.
     The state in the sequence only changes if n consecutive element are in a different state.
 
+    Parameters
+    ----------
+    seq : 1D np.array of type boolean
+        Sequence to be filtered.
+    n : int, default=5
+        Length of hysteresis memory.
+    n_false : int, optional, default=None
+        Length of hystresis memory applied for the false state.
+        This means the state is going to change to false when it encounters
+        n_false consecutive entries with value false.
+        If None, the same value is used for true and false.
+
+    Returns
+    -------
+    seq : 1D np.array of type boolean
+        Filtered sequence.
+    """
+    if n_false is None:
+        n_false = n
+    seq = np.asarray(seq).astype(np.bool_)
+    if len(seq) == 0:
+        return seq
+
+    # Run-length encoding of the sequence
+    run_starts = np.concatenate(([0], np.flatnonzero(seq[1:] != seq[:-1]) + 1))
+    run_lengths = np.diff(np.append(run_starts, len(seq)))
+    run_values = seq[run_starts]
+
+    # A run can only change the state if it is long enough for its value.
+    # The state changes at the first long run of the opposite value, so
+    # only the first run of each group of long runs with equal value counts.
+    long_runs = run_lengths >= np.where(run_values, n, n_false)
+    long_starts = run_starts[long_runs]
+    long_values = run_values[long_runs]
+    changes = long_values != np.concatenate(([seq[0]], long_values[:-1]))
+
+    states = np.concatenate(([seq[0]], long_values[changes]))
+    bounds = np.concatenate(([0], long_starts[changes], [len(seq)]))
+    return np.repeat(states, np.diff(bounds))
+
+def hysteresis_filter_loop(seq, n=5, n_false=None):
+    """
+    Element-wise reference implementation of hysteresis_filter.
+
     Parameters
     ----------
     seq : 1D np.array of type boolean
@@ -63,6 +109,57 @@ def hysteresis_filter(seq, n=5, n_false=None):
     seq[start_of_state:] = state
     return seq
 
+def laser_row_positions(path):
+    """
+    This function computes the position of the laser in every row of the
+    laser image. The image is read and thresholded once.
+
+    Parameters
+    ----------
+    path : string
+        Path to image file with laser on paper.
+
+    Returns
+    -------
+    1D np.array
+        Midpoint of the laser in pixels for every row, relative to the first
+        column of the central strip. Rows without laser are 0.
+    int
+        Column of the image where the central strip starts.
+    """
+    image = (io.imread(path) / np.iinfo(np.uint16).max * np.iinfo(np.uint8).max).astype(np.uint8)
+    off_set = int(image.shape[1] / 2 - 100)
+    image = image[:, off_set:off_set + 200]
+    val, thresh = cv2.threshold(image, 0, np.iinfo(image.dtype).max, cv2.THRESH_OTSU)
+    
+    mask = thresh > 0
+    has_laser = np.any(mask, axis=1)
+    first = np.argmax(mask, axis=1)
+    last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    results = np.where(has_laser, np.round((last - first) / 2 + first), 0)
+    
+    return results, off_set
+
+def laser_positions(path, lanes):
+    """
+    This function computes the average position of the laser for all slots.
+
+    Parameters
+    ----------
+    path : string
+        Path to image file with laser on paper.
+    lanes : list of int
+        First and last row of each slot, as written to lanes.csv.
+
+    Returns
+    -------
+    list of int
+        Position of laser in pixels for each slot.
+    """
+    results, off_set = laser_row_positions(path)
+    return [int(round(np.mean(results[lanes[i]:lanes[i + 1]]))) + off_set
+            for i in range(0, len(lanes) - 1, 2)]
+
 def laser_position(path, start, stop):
     """
     This function computes the average position of the laser within a slot.
@@ -81,67 +178,237 @@ def laser_position(path, start, stop):
     int
         Position of laser in pixels.
     """
-    image = (io.imread(path) / np.iinfo(np.uint16).max * np.iinfo(np.uint8).max).astype(np.uint8)
-    off_set = int(image.shape[1] / 2 - 100)
-    image = image[:, off_set:off_set + 200]
-    val, thresh = cv2.threshold(image, 0, np.iinfo(image.dtype).max, cv2.THRESH_OTSU)
-    
-    results = np.zeros(len(image))
-    
-    for i, row in enumerate(thresh):
-        indices = np.nonzero(row)[0]
-        if len(indices) == 0:
-            continue
-        results[i] = round((indices[-1] - indices[0]) / 2 + indices[0])
-    
-    return int(round(np.mean(results[start:stop]))) + off_set
+    return laser_positions(path, [start, stop])[0]
 
-def main(path_tif, path_laser_position, output_dir):
+def accumulate_images(video, thresh=28000, chunk_size=200):
     """
-    Main function for the first analysis step.
-    Separates the different slots and finds the positions of the walls and the laser.
+    This function computes the thresholded occupancy count and the mean image
+    of a video in a single pass over the frames.
 
     Parameters
     ----------
-    path_tif : string
-        Path to tif stack with video frames.
-    path_laser_position : string
-        Path to image with laser position.
+    video : 3D np.array or virtual_stack
+        Frames with shape (frames, rows, columns).
+    thresh : int, default=28000
+        Pixels brighter than this value count as occupied
+        (same as cv2.THRESH_BINARY).
+    chunk_size : int, default=200
+        Number of frames processed at once.
+
+    Returns
+    -------
+    thresh_count : 2D np.array of type uint32
+        Number of frames in which each pixel is above thresh.
+    average_image : 2D np.array of type float64
+        Mean over all frames.
+    """
+    thresh_count = np.zeros(video.shape[1:], dtype=np.uint32)
+    pixel_sum = np.zeros(video.shape[1:], dtype=np.uint64)
+    start_time = time.time()
+    for start in range(0, len(video), chunk_size):
+        chunk = video[start:start + chunk_size]
+        thresh_count += np.count_nonzero(chunk > thresh, axis=0).astype(np.uint32)
+        pixel_sum += np.sum(chunk, axis=0, dtype=np.uint64)
+        n_done = start + len(chunk)
+        print(f'{n_done} frames, {n_done / max(time.time() - start_time, 1e-9):.1f} frames/s')
+    average_image = pixel_sum / len(video)
+    return thresh_count, average_image
+
+def open_lane_writers(video, lanes, output_dir, lane_ids, lane_format='avi'):
+    """
+    This function opens an avi encoder and/or a lane store for each lane.
+
+    Parameters
+    ----------
+    video : 3D np.array or virtual_stack
+        Frames with shape (frames, rows, columns).
+    lanes : list of int
+        First and last row of each lane, as written to lanes.csv.
     output_dir : string
-        Directory where output is stored.
+        Directory where lane_N.avi / lane_N.npy files are stored.
+    lane_ids : list of int
+        Lanes to open.
+    lane_format : {'avi', 'npy', 'both'}, default='avi'
+        Write lossy lane videos, memory-mapped lane stores or both.
+
+    Returns
+    -------
+    writers : list of tuples
+        (lane_id, output_path, writer) for each output file.
+    """
+    assert lane_format in ('avi', 'npy', 'both'), 'unknown lane_format ' + lane_format
+    extensions = ['avi', 'npy'] if lane_format == 'both' else [lane_format]
+    writers = []
+    try:
+        for lane_id in lane_ids:
+            lane_shape = (lanes[2*lane_id+1] - lanes[2*lane_id], video.shape[2])
+            for ext in extensions:
+                output_path = os.path.join(output_dir, f'lane_{lane_id}.{ext}')
+                if ext == 'avi':
+                    writer = ffmpeg_writer(output_path, lane_shape, video.dtype)
+                else:
+                    writer = lane_store_writer(output_path, lane_shape, video.dtype, len(video))
+                writers.append((lane_id, output_path, writer))
+    except BaseException:
+        abort_lane_writers(writers)
+        raise
+    return writers
+
+def abort_lane_writers(writers):
+    """
+    This function stops all encoders after an error and removes the
+    unfinished lane stores.
+    """
+    for lane_id, output_path, writer in writers:
+        if isinstance(writer, ffmpeg_writer):
+            writer.proc.kill()
+            writer.close()
+        else:
+            writer.abort()
+
+def close_lane_writers(writers):
+    """
+    This function finishes all lane outputs and removes the failed ones.
+
+    Returns
+    -------
+    failed : list of string
+        Paths of the outputs that could not be written.
+    """
+    failed = []
+    for lane_id, output_path, writer in writers:
+        returncode = writer.close()
+        print(f'{os.path.basename(output_path)}: exit status {returncode}')
+        if returncode != 0:
+            failed.append(output_path)
+    for output_path in failed:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+    return failed
+
+class lane_feeder(object):
+    """
+    Feed each lane output from its own thread and queue, so all encoders
+    work while the next chunk of the recording is read.
+    """
+
+    def __init__(self, writers, lanes, depth=2):
+        """
+        Start one thread per output.
+
+        Parameters
+        ----------
+        writers : list of tuples
+            (lane_id, output_path, writer), see open_lane_writers.
+        lanes : list of int
+            First and last row of each lane, as written to lanes.csv.
+        depth : int, default=2
+            Number of chunks queued per output before write blocks.
+        """
+        self.writers = writers
+        self.lanes = lanes
+        self.errors = []
+        self.queues = [queue.Queue(maxsize=depth) for w in writers]
+        self.threads = [threading.Thread(target=self._feed, args=(writer, blocks))
+                        for (lane_id, output_path, writer), blocks in zip(writers, self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def _feed(self, writer, blocks):
+        # after an error the remaining blocks are discarded, so write never
+        # blocks on a failed output
+        failed = False
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            if failed:
+                continue
+            try:
+                writer.write(block)
+            except BaseException as e:
+                self.errors.append(e)
+                failed = True
+
+    def write(self, chunk):
+        """
+        Queue the lanes of a chunk of frames.
+
+        Parameters
+        ----------
+        chunk : 3D np.array
+            Frames with shape (frames, rows, columns).
+        """
+        for (lane_id, output_path, writer), blocks in zip(self.writers, self.queues):
+            blocks.put(chunk[:, self.lanes[2*lane_id]:self.lanes[2*lane_id+1], :])
+
+    def stop(self):
+        """
+        Wait until all queued frames are written and stop the threads.
+        """
+        for blocks in self.queues:
+            blocks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def finish(self):
+        """
+        Stop the threads and raise the first error of a writer thread.
+        """
+        self.stop()
+        if self.errors:
+            raise self.errors[0]
+
+def encode_lanes(video, lanes, output_dir, chunk_size=200, lane_format='avi'):
+    """
+    This function encodes every lane of a video into its own avi file
+    and/or lane store (see lane_store). The frames are read once; all
+    outputs are written at the same time, each from its own thread
+    (see lane_feeder).
+
+    Parameters
+    ----------
+    video : 3D np.array or virtual_stack
+        Frames with shape (frames, rows, columns).
+    lanes : list of int
+        First and last row of each lane, as written to lanes.csv.
+    output_dir : string
+        Directory where lane_N.avi / lane_N.npy files are stored.
+    chunk_size : int, default=200
+        Number of frames read at once.
+    lane_format : {'avi', 'npy', 'both'}, default='avi'
+        Write lossy lane videos, memory-mapped lane stores or both.
+    """
+    writers = open_lane_writers(video, lanes, output_dir, range(len(lanes) // 2), lane_format)
+    try:
+        feeder = lane_feeder(writers, lanes)
+        try:
+            for start in range(0, len(video), chunk_size):
+                feeder.write(video[start:start + chunk_size])
+        except BaseException:
+            feeder.stop()
+            raise
+        feeder.finish()
+    except BaseException:
+        abort_lane_writers(writers)
+        raise
+    failed = close_lane_writers(writers)
+    assert len(failed) == 0, f'failed to write {failed}'
+
+def find_lanes(average_thresh_image):
+    """
+    This function finds the rows that separate the slots.
+
+    Parameters
+    ----------
+    average_thresh_image : 2D np.array
+        Image that is nonzero where the fly was seen at least once.
+
+    Returns
+    -------
+    lanes : list of int
+        First and last row of each slot.
     """
-    print('start to read : '+path_tif)
-    path = os.path.expanduser(os.path.expandvars(path_tif))
-    full_video = io.imread(path)
-    # if files were renamed it fails to automatically load all files
-    if len(full_video) < 18000:
-        full_video = np.concatenate((full_video, io.imread(path[:-8] + '_1.ome.tif')), axis=0)
-    if len(full_video) < 18000:
-        full_video = np.concatenate((full_video, io.imread(path[:-8] + '_2.ome.tif')), axis=0)
-    if len(full_video) < 18000:
-        full_video = np.concatenate((full_video, io.imread(path[:-8] + '_3.ome.tif')), axis=0)
-    if len(full_video) < 18000:
-        full_video = np.concatenate((full_video, io.imread(path[:-8] + '_4.ome.tif')), axis=0)
-    assert len(full_video) >= 18000
-        
-    
-    average_thresh_image = np.zeros_like(full_video[0])
-    average_image = np.zeros_like(full_video[0])
-    
-    for i,frame in enumerate(full_video):
-        if i % 100 == 0:
-            print(i)
-        #thresh = cv2.threshold(frame, 0, 65535, cv2.THRESH_OTSU)
-        thresh = cv2.threshold(frame, 28000, np.iinfo(frame.dtype).max, cv2.THRESH_BINARY)
-        #io.imsave(f'thresh{i}.tif', thresh[1])
-        average_thresh_image += thresh[1]
-        #average_image += frame
-    
-    average_thresh_image = average_thresh_image / len(full_video)
-    #average_image = average_image / len(full_video)
-    average_image = np.mean(full_video, axis=0)
-    #io.imsave('result.tif', average_thresh_image.astype(np.uint16))
-    
     bool_rows = np.any(average_thresh_image, axis=1)
     bool_rows = hysteresis_filter(bool_rows, 50, 1)
     
@@ -156,31 +423,26 @@ def main(path_tif, path_laser_position, output_dir):
             new_lane = True
     if len(lanes) == 7:
         lanes.append(len(bool_rows))
-    print(lanes)
-    with open(os.path.join(output_dir,'lanes.csv'), 'w') as fp:
-        wr = csv.writer(fp, quoting=csv.QUOTE_ALL)
-        wr.writerow(lanes)
-    
-    assert len(lanes) == 8
-    now = datetime.datetime.now()
-    unix = str(int(time.mktime(now.timetuple())))
-    frame_path = 'frames' + unix
-    if not os.path.exists(frame_path):
-        os.makedirs(frame_path)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    for i in range(0, len(lanes)-1, 2):
-        lane_id = int(i/2)
-        #io.imsave(f'lane{lane_id}.tif', full_video[:, lanes[i]:lanes[i+1], :])
-        for j,img in enumerate(full_video[:, lanes[i]:lanes[i+1], :]):
-            io.imsave(f'{frame_path}/lane_{lane_id}_frame_{j}.tif', img)
-        video_output_path = os.path.join(output_dir, f'lane_{lane_id}.avi')
-        call(['ffmpeg', '-y', '-i', f'{frame_path}/lane_{lane_id}_frame_%d.tif', video_output_path])
-    shutil.rmtree(frame_path)
-    
-    position = {'slot_0': {}, 'slot_1': {}, 'slot_2': {}, 'slot_3': {}}
-    path_laser_position = os.path.expanduser(os.path.expandvars(path_laser_position))
+    return lanes
 
+def wall_positions(average_image, lanes):
+    """
+    This function finds the left and right wall of each slot.
+
+    Parameters
+    ----------
+    average_image : 2D np.array
+        Mean over the frames of the video.
+    lanes : list of int
+        First and last row of each slot.
+
+    Returns
+    -------
+    position : dict
+        Dictionary with keys slot_0, ..., slot_3 each holding a dictionary
+        with the keys left_wall and right_wall.
+    """
+    position = {'slot_0': {}, 'slot_1': {}, 'slot_2': {}, 'slot_3': {}}
     for i in [0, 1, 2, 3]:
         #io.imsave(f'average_imgage_lane_{i}.tif', average_image[lanes[i * 2] : lanes[i * 2 + 1]].astype(np.uint16))
         #io.imsave(f'soblex_{i}.tif', cv2.Sobel(average_image[lanes[i *2] : lanes[i * 2 +1]], cv2.CV_16U, 1, 0, ksize=5))
@@ -197,14 +459,143 @@ def main(path_tif, path_laser_position, output_dir):
         mid_col_num = int((lanes[i * 2 + 1] - lanes[i * 2]) / 2) # int(np.mean([lanes[i * 2], lanes[i * 2 + 1]]))
         left_slot_col_num = np.argwhere(left_wall_thresh_image[mid_col_num]>0)
         right_slot_col_num = np.argwhere(right_wall_thresh_image[mid_col_num]>0)
-        position[f'slot_{i}']['left_wall'] = int(left_slot_col_num[0])
-        position[f'slot_{i}']['right_wall'] = int(right_slot_col_num[-1] + average_image.shape[1] - 40)
-        position[f'slot_{i}']['laser'] = laser_position(path_laser_position, lanes[i * 2], lanes[i * 2 + 1])
+        position[f'slot_{i}']['left_wall'] = int(left_slot_col_num[0, 0])
+        position[f'slot_{i}']['right_wall'] = int(right_slot_col_num[-1, 0] + average_image.shape[1] - 40)
+    return position
+
+def quick_calibrate(video, thresh=28000, batch_size=100, patience=5, max_frames=6000, seed=0):
+    """
+    This function estimates the lanes and walls from a random subset of frames.
+    Frames are sampled in batches until the estimate did not change for
+    patience consecutive batches or max_frames frames were used.
+
+    Parameters
+    ----------
+    video : 3D np.array or virtual_stack
+        Frames with shape (frames, rows, columns).
+    thresh : int, default=28000
+        Pixels brighter than this value count as occupied.
+    batch_size : int, default=100
+        Number of frames sampled between two estimates.
+    patience : int, default=5
+        Number of unchanged estimates after which sampling stops.
+    max_frames : int, default=6000
+        Maximal number of frames sampled.
+    seed : int, default=0
+        Seed for the frame sampling.
+
+    Returns
+    -------
+    lanes : list of int
+        First and last row of each slot.
+    position : dict
+        Wall positions of each slot, see wall_positions.
+    calibration : dict
+        Number of frames sampled and confidence. The confidence is the
+        fraction of the sampled frames that were added after the estimate
+        changed for the last time.
+    """
+    order = np.random.RandomState(seed).permutation(len(video))[:max_frames]
+    thresh_count = np.zeros(video.shape[1:], dtype=np.uint32)
+    pixel_sum = np.zeros(video.shape[1:], dtype=np.uint64)
+    estimate = None
+    n_at_change = 0
+    stable = 0
+    n_sampled = 0
+    for start in range(0, len(order), batch_size):
+        for j in np.sort(order[start:start + batch_size]):
+            frame = video[int(j)]
+            thresh_count += frame > thresh
+            pixel_sum += frame
+        n_sampled = min(start + batch_size, len(order))
+        
+        lanes = find_lanes(thresh_count)
+        new_estimate = None
+        if len(lanes) == 8:
+            try:
+                new_estimate = (lanes, wall_positions(pixel_sum / n_sampled, lanes))
+            except IndexError:
+                # no wall visible in the sampled frames yet
+                pass
+        if new_estimate is not None and new_estimate == estimate:
+            stable += 1
+        else:
+            estimate = new_estimate
+            n_at_change = n_sampled
+            stable = 0
+        print(f'{n_sampled} frames sampled, lanes {lanes}, stable for {stable} batches')
+        if estimate is not None and stable >= patience:
+            break
+    
+    if estimate is None:
+        raise RuntimeError(f'quick calibration did not find 4 slots in {n_sampled} frames, '
+                           'run step_1.py without --quick')
+    calibration = {'frames_sampled': int(n_sampled),
+                   'confidence': round(1 - n_at_change / n_sampled, 3)}
+    return estimate[0], estimate[1], calibration
+
+def main(path_tif, path_laser_position, output_dir, chunk_size=200, quick=False,
+         lane_format='avi'):
+    """
+    Main function for the first analysis step.
+    Separates the different slots and finds the positions of the walls and the laser.
+
+    Parameters
+    ----------
+    path_tif : string
+        Path to tif stack with video frames.
+    path_laser_position : string
+        Path to image with laser position.
+    output_dir : string
+        Directory where output is stored.
+    chunk_size : int, default=200
+        Number of frames held in memory at a time.
+    quick : bool, default=False
+        Only estimate the lanes and the wall and laser positions from a sample
+        of frames, see quick_calibrate, and write them with the sampling
+        statistics to calibration.json. lanes.csv, position.json and the lane
+        videos are not written.
+    lane_format : {'avi', 'npy', 'both'}, default='avi'
+        Write lossy lane videos, memory-mapped lane stores or both.
+    """
+    print('start to read : '+path_tif)
+    full_video = open_mmstack(path_tif)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    if quick:
+        lanes, position, calibration = quick_calibrate(full_video)
+        print(lanes)
+    else:
+        thresh_count, average_image = accumulate_images(full_video, 28000, chunk_size)
+        average_thresh_image = thresh_count / len(full_video)
+        #io.imsave('result.tif', average_thresh_image.astype(np.uint16))
+        lanes = find_lanes(average_thresh_image)
+        print(lanes)
+        with open(os.path.join(output_dir,'lanes.csv'), 'w') as fp:
+            wr = csv.writer(fp, quoting=csv.QUOTE_ALL)
+            wr.writerow(lanes)
+        
+        assert len(lanes) == 8
+        encode_lanes(full_video, lanes, output_dir, chunk_size, lane_format)
+        position = wall_positions(average_image, lanes)
     
+    path_laser_position = os.path.expanduser(os.path.expandvars(path_laser_position))
+    lasers = laser_positions(path_laser_position, lanes)
+    for i in [0, 1, 2, 3]:
+        position[f'slot_{i}']['laser'] = lasers[i]
+    
+    if quick:
+        # the lane videos of a previous run were cut with lanes.csv, which
+        # must therefore stay as it is
+        calibration['lanes'] = lanes
+        calibration['position'] = position
+        with open(os.path.join(output_dir, 'calibration.json'), 'w') as fp:
+            json.dump(calibration, fp, sort_keys=True, indent=4)
+        return
     position_output_path = os.path.join(output_dir, 'position.json')
     with open(position_output_path, 'w') as fp:
         json.dump(position, fp, sort_keys=True, indent=4)
 
-
 if __name__ == '__main__':
     argh.dispatch_command(main)
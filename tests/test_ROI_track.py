@@ -0,0 +1,79 @@
+import numpy as np
+import scipy
+import pytest
+from ROI_track import classify_ROIs
+
+# ROI_track uses the numpy functions that older scipy versions re-export
+pytestmark = pytest.mark.skipif(not hasattr(scipy, 'zeros'),
+                                reason='ROI_track needs a scipy that re-exports numpy')
+
+
+def noisy_ROIs(num_frames, num_slots, mean_run, seed):
+    """
+    ROI labels 0-5 that change after runs of random length, as in
+    bench_ROI_corrected.py.
+    """
+    rng = np.random.RandomState(seed)
+    data = np.zeros((num_frames, num_slots))
+    for iS in range(num_slots):
+        steps = (rng.random_sample(num_frames) < 1. / mean_run) * rng.randint(1, 6, num_frames)
+        data[:, iS] = np.cumsum(steps) % 6
+    return data
+
+
+def classifier(raw_ROI, min_ROI_sec=0.25, fps=60):
+    a = classify_ROIs(3. / 106, 3.5, fps, min_ROI_sec, raw_ROI.shape[1])
+    a.num_frames = len(raw_ROI)
+    a.raw_ROI = raw_ROI
+    a.corr_ROI = raw_ROI.copy()
+    return a
+
+
+@pytest.mark.parametrize('mean_run, min_ROI_sec', [(4., 0.25), (20., 0.25), (10., 0.05), (4., 1.)])
+def test_ROI_corrected_matches_loop(mean_run, min_ROI_sec):
+    raw_ROI = noisy_ROIs(5000, 4, mean_run, seed=int(mean_run))
+    a = classifier(raw_ROI, min_ROI_sec)
+    a.ROI_corrected()
+    b = classifier(raw_ROI, min_ROI_sec)
+    b.ROI_corrected_loop()
+    assert not np.array_equal(a.corr_ROI, raw_ROI)
+    assert np.array_equal(a.corr_ROI, b.corr_ROI)
+
+
+def ROI_splits_loop(corr_ROI):
+    """
+    get_ROI_splits as it was before the table was built at once, without
+    the all-zero first row.
+    """
+    num_frames, num_slots = corr_ROI.shape
+    splits = []
+    for iS in range(num_slots):
+        split_idxs = np.nonzero(np.diff(corr_ROI[:, iS]))[0]
+        split_idxs = np.hstack(([-1], split_idxs))
+        if (num_frames - 1) not in split_idxs:
+            split_idxs = np.hstack((split_idxs, num_frames - 1))
+        for iI in range(len(split_idxs) - 1):
+            idx_beg = split_idxs[iI] + 1
+            idx_end = split_idxs[iI + 1] + 1
+            if idx_beg + 1 >= num_frames:
+                continue
+            splits.append([corr_ROI[idx_beg + 1, iS], idx_beg, idx_end, iS])
+    return np.array(splits, dtype=int).reshape(-1, 4).T
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_get_ROI_splits_matches_loop(seed):
+    corr_ROI = noisy_ROIs(3000, 4, 30., seed)
+    # a change at the last frame gives a segment that is dropped
+    corr_ROI[-1, 0] = (corr_ROI[-2, 0] + 1) % 6
+    a = classifier(corr_ROI)
+    a.get_ROI_splits()
+    assert np.array_equal(a.ROI_splits, ROI_splits_loop(corr_ROI))
+
+
+def test_get_ROI_splits_constant_slots():
+    corr_ROI = np.zeros((100, 4))
+    corr_ROI[:, 2] = 3
+    a = classifier(corr_ROI)
+    a.get_ROI_splits()
+    assert np.array_equal(a.ROI_splits, [[0, 0, 3, 0], [0, 0, 0, 0], [100] * 4, [0, 1, 2, 3]])
@@ -0,0 +1,40 @@
+import os
+import glob
+import numpy as np
+from centroid_cache import cache_path, load_export, load_centroid_x
+
+
+def write_export(path, values, mtime):
+    np.savetxt(path, values, fmt='%.3f', delimiter=',')
+    os.utime(path, (mtime, mtime))
+
+
+def test_load_export_caches_and_invalidates(tmp_path):
+    path = str(tmp_path / 'lane_0.avi_x.txt')
+    write_export(path, [[1.5, 2], [3, 4]], 1000)
+    assert np.array_equal(load_export(path), [[1.5, 2], [3, 4]])
+    assert os.path.exists(cache_path(path))
+    # the second load comes from the cache
+    assert isinstance(load_export(path), np.memmap)
+
+    # a rewritten export with the same size still gets a new cache
+    write_export(path, [[2.5, 2], [3, 4]], 2000)
+    assert np.array_equal(load_export(path), [[2.5, 2], [3, 4]])
+    assert glob.glob(path + '.*.cache.npy') == [cache_path(path)]
+
+
+def test_load_export_whitespace_separated(tmp_path):
+    path = str(tmp_path / 'lane_0.avi_y.txt')
+    with open(path, 'w') as fp:
+        fp.write('1.0\t2.0\n3.0\t4.0\n')
+    assert np.array_equal(load_export(path, mmap_mode=None), [[1, 2], [3, 4]])
+
+
+def test_load_centroid_x_prefers_exports(tmp_path):
+    in_dir = str(tmp_path)
+    np.save(os.path.join(in_dir, 'tracks.npy'), np.zeros((2, 2, 3), dtype=np.float32))
+    assert np.array_equal(load_centroid_x(in_dir, 2), np.zeros((2, 2)))
+    for lane_id in range(2):
+        write_export(os.path.join(in_dir, f'lane_{lane_id}.avi_x.txt'),
+                     [[lane_id + 1, 0], [lane_id + 2, 0]], 1000)
+    assert np.array_equal(load_centroid_x(in_dir, 2), [[1, 2], [2, 3]])
@@ -0,0 +1,25 @@
+import numpy as np
+from centroid_tracker import track_chunk, save_tracks
+from centroid_cache import load_centroid_x
+from check_orient import load_track
+
+
+def test_track_chunk_uses_tpro_coordinates():
+    background = np.full((61, 300), 40000, dtype=np.uint16)
+    chunk = background[np.newaxis].copy()
+    # rows 26..33 and columns 200..229, i.e. 1-based rows 27..34 and columns 201..230
+    chunk[0, 26:34, 200:230] = 5000
+    x, y, angle = track_chunk(chunk, background)
+    assert np.isclose(x[0], 215.5)
+    assert np.isclose(61 - y[0], 30.5)
+    assert np.isclose(angle[0], 0)
+
+
+def test_saved_tracks_keep_untracked_frames(tmp_path):
+    output_dir = str(tmp_path)
+    tracks = np.array([[[np.nan, np.nan, np.nan]], [[10, 20, 30]], [[np.nan, np.nan, np.nan]]],
+                      dtype=np.float32)
+    save_tracks(output_dir, tracks, [np.zeros((61, 300))])
+    x, y, angle = load_track(output_dir, 0)
+    assert np.array_equal(np.isnan(x), [True, False, True])
+    assert np.array_equal(load_centroid_x(output_dir, 1)[:, 0], [10, 10, 10])
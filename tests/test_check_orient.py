@@ -0,0 +1,124 @@
+import numpy as np
+from scipy import ndimage
+from check_orient import matlab_round, fly_box_images, side_view_flags
+
+
+def matlab_box(image, pt_x, pt_y, angle, box_size):
+    """
+    Frame by frame transcription of getOneFlyBoxImage_ in check_orient.m,
+    with imrotate done by scipy.ndimage.
+    """
+    trim = box_size * 3 // 2
+    rect = [pt_x - trim / 2., pt_y - trim / 2., trim, trim]
+    if rect[1] < 0:
+        rect[3] = rect[3] + np.floor(rect[1]) * 2
+        rect[1] = 0
+    if rect[1] + trim > image.shape[0]:
+        rect[3] = rect[3] - np.floor(rect[1])
+        rect[1] = rect[1] * 2
+    r1, r2 = int(matlab_round(rect[1])), int(matlab_round(rect[1] + rect[3]))
+    c1, c2 = int(matlab_round(rect[0])), int(matlab_round(rect[0] + rect[2]))
+    if r1 > image.shape[0] or r2 < 1 or c1 > image.shape[1] or c2 < 1:
+        trimmed = np.zeros((0, 0))
+    else:
+        trimmed = image[max(r1, 1) - 1:min(r2, image.shape[0]),
+                        max(c1, 1) - 1:min(c2, image.shape[1])]
+    if rect[3] < trim:
+        h, w = trimmed.shape
+        bg_y = max(trim // 2 - h // 2, 1)
+        bg_x = max(trim // 2 - w // 2, 1)
+        ed_tr_x = min(w, trim)
+        box = np.zeros((max(trim, bg_y + h - 1), max(trim, bg_x + ed_tr_x - 1)))
+        box[bg_y - 1:bg_y - 1 + h, bg_x - 1:bg_x - 1 + ed_tr_x] = trimmed[:, :ed_tr_x]
+        trimmed = box
+
+    theta = np.radians(270. - angle)
+    matrix = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
+    centre = (np.array(trimmed.shape) - 1) / 2.
+    rotated = ndimage.affine_transform(np.asarray(trimmed, dtype=np.float64), matrix,
+                                       centre - matrix @ centre, order=1,
+                                       mode='grid-constant', cval=0)
+    rotated = np.clip(matlab_round(rotated), 0, 255)
+
+    start = int(matlab_round((trim - box_size) / 2.))
+    stop = int(matlab_round((trim + box_size) / 2.))
+    return rotated[start - 1:stop, start - 1:stop][:box_size, :box_size]
+
+
+def matlab_side_view(image, background, pt_x, pt_y, angle, box_size=80, side_th=15):
+    """
+    Side view check of check_orient.m for one frame.
+    """
+    box = matlab_box(np.clip(background - image, 0, 255), pt_x, pt_y, angle, box_size)
+    box[box > 20] = 255
+    # graythresh
+    counts = np.bincount(box.astype(int).ravel(), minlength=256).astype(np.float64)
+    p = counts / counts.sum()
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(1, 257))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma_b = (mu[-1] * omega - mu)**2 / (omega * (1 - omega))
+    level = 0.
+    if np.any(np.isfinite(sigma_b)):
+        max_val = np.nanmax(sigma_b)
+        level = np.mean(np.flatnonzero(sigma_b == max_val) + 1) - 1
+    fly = box > level
+    width = fly.shape[1]
+    return np.any(fly[:, :side_th]) != np.any(fly[:, width - side_th:])
+
+
+def fly_frames(seed=0, n=200, height=61, width=300):
+    """
+    Frames of a dark elongated fly with legs on a noisy background, at
+    random positions that reach the edges of the lane.
+    """
+    rng = np.random.RandomState(seed)
+    background = np.full((height, width), 180.) + rng.randint(-3, 4, (height, width))
+    rows, cols = np.mgrid[:height, :width]
+    x = rng.uniform(-5, width + 5, n)
+    y = np.concatenate((rng.uniform(-5, 15, n // 2), rng.uniform(height - 15, height + 5, n - n // 2)))
+    angle = rng.uniform(0, 180, n)
+    images = np.empty((n, height, width), dtype=np.uint8)
+    for i in range(n):
+        t = np.radians(angle[i])
+        u = (cols + 1 - x[i]) * np.cos(t) - (rows + 1 - y[i]) * np.sin(t)
+        v = (cols + 1 - x[i]) * np.sin(t) + (rows + 1 - y[i]) * np.cos(t)
+        body = (u / 14.)**2 + (v / 5.)**2 < 1
+        leg = (np.abs(v - 9 * (i % 3 - 1)) < 1.5) & (np.abs(u) < 20)
+        frame = background - 120 * body - 60 * leg + rng.randint(-10, 11, (height, width))
+        images[i] = np.clip(frame, 0, 255)
+    return images, np.round(background).astype(np.uint8), x, y, angle
+
+
+def test_fly_box_images_matches_matlab_geometry():
+    images, background, x, rows, angle = fly_frames()
+    diff = np.clip(background.astype(np.float32) - images, 0, 255)
+    boxes, valid = fly_box_images(diff, x, rows, angle)
+    for i in range(len(images)):
+        expected = matlab_box(diff[i], x[i], rows[i], angle[i], 80)
+        h, w = expected.shape
+        assert np.all(valid[i, :h, :w]) and not np.any(valid[i, h:]) and not np.any(valid[i, :, w:])
+        # bilinear sums can round differently at .5
+        assert np.max(np.abs(boxes[i, :h, :w].astype(int) - expected)) <= 1
+
+
+def test_side_view_flags_match_matlab():
+    images, background, x, rows, angle = fly_frames(seed=1)
+    flags = side_view_flags(images, background, x, rows, angle)
+    expected = [matlab_side_view(images[i].astype(np.float64), background.astype(np.float64),
+                                 x[i], rows[i], angle[i]) for i in range(len(images))]
+    assert np.any(expected) and not np.all(expected)
+    assert np.array_equal(flags, expected)
+
+
+def test_otsu_finds_faint_fly():
+    # no pixel differs by more than 20 from the background; the Otsu
+    # threshold still separates the fly, which reaches the left border
+    background = np.full((61, 300), 100, dtype=np.uint8)
+    image = background.copy()
+    image[25:35, 125:150] = 88
+    args = (np.array([160.]), np.array([30.]), np.array([270.]))
+    flags = side_view_flags(image[np.newaxis], background, *args)
+    assert flags[0]
+    assert matlab_side_view(image.astype(np.float64), background.astype(np.float64),
+                            160., 30., 270.)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import numpy as np
+import cv2
+import pytest
+import clip_export
+from clip_export import export_clips, probe_video, probe_keyframes
+from ffmpeg_pipe import ffmpeg_writer
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                reason='ffmpeg and ffprobe are required')
+
+RANGES = ([5, 50, 80], [37, 60, 100])
+
+
+def numbered_video(path, n_frames=100, gop=10):
+    """
+    Lane-sized mpeg4 avi of a bright block that moves 2 pixels per frame,
+    so frame i shows the block at columns 2 i to 2 i + 8.
+    """
+    with ffmpeg_writer(path, (60, 300), np.uint8, extra_args=['-c:v', 'mpeg4', '-q:v', '2',
+                                                              '-g', str(gop)]) as writer:
+        for i in range(n_frames):
+            frame = np.full((60, 300), 40, dtype=np.uint8)
+            frame[20:40, 2 * i:2 * i + 8] = 220
+            writer.write(frame)
+
+
+def frame_numbers(path):
+    cap = cv2.VideoCapture(path)
+    numbers = []
+    ret, frame = cap.read()
+    while ret:
+        profile = frame[20:40, :, 0].mean(axis=0) > 130
+        numbers.append(int(round((np.flatnonzero(profile).mean() - 3.5) / 2.)))
+        ret, frame = cap.read()
+    cap.release()
+    return numbers
+
+
+def expected_frames():
+    return [i for start, stop in zip(*RANGES) for i in range(start, stop)]
+
+
+def test_probe(tmp_path):
+    path = str(tmp_path / 'lane_0.avi')
+    numbered_video(path)
+    keyframes, n_frames = probe_keyframes(path)
+    assert n_frames == 100
+    assert np.array_equal(keyframes, np.arange(0, 100, 10))
+    assert probe_video(path, count_frames=True)['n_frames'] == 100
+
+
+def test_export_clips_copies_whole_gops(tmp_path):
+    path = str(tmp_path / 'lane_0.avi')
+    output_path = str(tmp_path / 'lane_0_topbyroi.avi')
+    numbered_video(path)
+    copied = export_clips(path, *RANGES, output_path)
+    # frames 10-30, 50-60 and 80-100 start and end at keyframes or the end
+    assert copied == 50
+    assert probe_video(output_path, count_frames=True)['n_frames'] == len(expected_frames())
+    assert frame_numbers(output_path) == expected_frames()
+
+
+def test_export_clips_falls_back_to_reencoding(tmp_path, monkeypatch):
+    path = str(tmp_path / 'lane_0.avi')
+    output_path = str(tmp_path / 'lane_0_topbyroi.avi')
+    numbered_video(path)
+    monkeypatch.setattr(clip_export, 'matches_stream', lambda part_path, info: False)
+    assert export_clips(path, *RANGES, output_path) == 0
+    assert frame_numbers(output_path) == expected_frames()
+    assert sorted(os.listdir(str(tmp_path))) == ['lane_0.avi', 'lane_0_topbyroi.avi']
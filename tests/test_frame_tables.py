@@ -0,0 +1,34 @@
+import os
+import numpy as np
+import pytest
+from frame_tables import save_table, load_table, table_exists, table_dtype
+
+
+@pytest.mark.parametrize('table_format', ['txt', 'npy', 'both'])
+def test_save_load_round_trip(tmp_path, table_format):
+    out_dir = str(tmp_path)
+    data = np.random.RandomState(0).randint(0, 6, (1000, 4))
+    assert not table_exists(out_dir, 'corrected_ROIs')
+    save_table(out_dir, 'corrected_ROIs', data, table_format)
+    assert table_exists(out_dir, 'corrected_ROIs')
+    table = load_table(out_dir, 'corrected_ROIs')
+    assert np.array_equal(table, data)
+    if table_format != 'txt':
+        assert np.load(os.path.join(out_dir, 'corrected_ROIs.npy')).dtype == np.int8
+
+
+def test_table_dtype():
+    assert table_dtype(np.zeros((0, 4))) == np.int8
+    assert table_dtype([[-128, 127]]) == np.int8
+    assert table_dtype([[0, 200000]]) == np.int32
+    assert table_dtype([[0, 2**40]]) == np.int64
+
+
+def test_load_table_uses_newer_text_table(tmp_path):
+    out_dir = str(tmp_path)
+    save_table(out_dir, 'ROI_frame_splits', np.array([[1, 0, 10, 0]]), 'npy')
+    # e.g. rewritten by an earlier version of the pipeline
+    np.savetxt(os.path.join(out_dir, 'ROI_frame_splits.txt'), [[2, 0, 20, 1]], fmt='%d',
+               delimiter='\t')
+    os.utime(os.path.join(out_dir, 'ROI_frame_splits.npy'), (1000, 1000))
+    assert np.array_equal(load_table(out_dir, 'ROI_frame_splits'), [[2, 0, 20, 1]])
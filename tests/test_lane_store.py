@@ -0,0 +1,48 @@
+import os
+import numpy as np
+from lane_store import lane_store_writer, lane_reader, open_lane
+
+
+def test_lane_store_replaces_output_when_complete(tmp_path):
+    path = str(tmp_path / 'lane_0.npy')
+    np.save(path, np.zeros((1, 2, 3), dtype=np.uint16))
+    frames = np.arange(4 * 2 * 3, dtype=np.uint16).reshape(4, 2, 3)
+    writer = lane_store_writer(path, (2, 3), np.uint16, 4)
+    writer.write(frames[:3])
+    # the old store stays readable until the new one is complete
+    assert np.load(path).shape == (1, 2, 3)
+    writer.write(frames[3])
+    assert writer.close() == 0
+    assert np.array_equal(np.load(path), frames)
+    assert os.listdir(str(tmp_path)) == ['lane_0.npy']
+
+
+def test_lane_store_abort_and_incomplete_keep_old_output(tmp_path):
+    path = str(tmp_path / 'lane_0.npy')
+    old = np.ones((1, 2, 3), dtype=np.uint16)
+    np.save(path, old)
+    writer = lane_store_writer(path, (2, 3), np.uint16, 4)
+    writer.write(np.zeros((2, 2, 3), dtype=np.uint16))
+    writer.abort()
+    writer = lane_store_writer(path, (2, 3), np.uint16, 4)
+    writer.write(np.zeros((2, 2, 3), dtype=np.uint16))
+    assert writer.close() == 1
+    assert np.array_equal(np.load(path), old)
+    assert os.listdir(str(tmp_path)) == ['lane_0.npy']
+
+
+def test_open_lane_prefers_newer_file(tmp_path):
+    input_dir = str(tmp_path)
+    store_path = os.path.join(input_dir, 'lane_0.npy')
+    video_path = os.path.join(input_dir, 'lane_0.avi')
+    np.save(store_path, np.zeros((1, 2, 3), dtype=np.uint16))
+    assert isinstance(open_lane(input_dir, 0), lane_reader)
+
+    open(video_path, 'wb').close()
+    os.utime(store_path, (1000, 1000))
+    assert not isinstance(open_lane(input_dir, 0), lane_reader)
+    assert isinstance(open_lane(input_dir, 0, 'npy'), lane_reader)
+
+    os.utime(video_path, (500, 500))
+    assert isinstance(open_lane(input_dir, 0), lane_reader)
+    assert not isinstance(open_lane(input_dir, 0, 'avi'), lane_reader)
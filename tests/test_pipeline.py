@@ -0,0 +1,34 @@
+import numpy as np
+from centroid_tracker import track_chunk
+from pipeline import orient_chunk
+
+
+def lane_chunk(height=61, width=300):
+    """
+    Three 16-bit frames of a lane: a fly at the bottom edge, no fly, and a
+    fly in the middle of the lane.
+    """
+    background = np.full((height, width), 40000, dtype=np.uint16)
+    chunk = np.repeat(background[np.newaxis], 3, axis=0)
+    chunk[0, 50:58, 100:130] = 5000
+    chunk[2, 26:34, 200:230] = 5000
+    return chunk, background
+
+
+def test_orient_chunk_skips_blank_frames():
+    chunk, background = lane_chunk()
+    x, y, angle = track_chunk(chunk, background)
+    assert np.isnan(x[1]) and np.isnan(y[1])
+
+    background_8bit = np.round(background / 256.)
+    flags = orient_chunk(chunk, background_8bit, x, y, angle)
+    assert flags.shape == (3,)
+    assert flags[1] == 0 and flags[2] == 0
+
+
+def test_orient_chunk_all_blank():
+    chunk, background = lane_chunk()
+    chunk[:] = background
+    x, y, angle = track_chunk(chunk, background)
+    flags = orient_chunk(chunk, np.round(background / 256.), x, y, angle)
+    assert np.array_equal(flags, [0, 0, 0])
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from smoothing import box_smooth, box_smooth_loop
+
+
+@pytest.mark.parametrize('window', [1, 2, 6, 7, 60])
+def test_box_smooth_wrap_matches_loop(window):
+    traces = np.cumsum(np.random.RandomState(window).randn(500, 4), axis=0) + 400
+    expected = np.stack([box_smooth_loop(traces[:, i], window) for i in range(4)], axis=1)
+    assert np.allclose(box_smooth(traces, window), expected, rtol=0, atol=1e-9)
+    assert np.allclose(box_smooth(traces.T, window, axis=1), expected.T, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('window', [2, 7])
+def test_box_smooth_edge_modes(window):
+    trace = np.random.RandomState(0).rand(50)
+    before, after = (window - 1) // 2, window // 2
+    nearest = np.concatenate(([trace[0]] * before, trace, [trace[-1]] * after))
+    expected = [nearest[i:i + window].mean() for i in range(len(trace))]
+    assert np.allclose(box_smooth(trace, window, mode='nearest'), expected)
+    expected = [trace[max(i - before, 0):i + after + 1].mean() for i in range(len(trace))]
+    assert np.allclose(box_smooth(trace, window, mode='shrink'), expected)
+
+
+def test_box_smooth_nan_only_affects_its_windows():
+    trace = np.arange(20, dtype=np.float64)
+    trace[10] = np.nan
+    # sample i averages samples i - 1 to i + 2
+    smoothed = box_smooth(trace, 4, mode='nearest')
+    assert np.array_equal(np.isnan(smoothed), np.isin(np.arange(20), [8, 9, 10, 11]))
+    assert np.allclose(smoothed[:8], box_smooth(np.arange(20.), 4, mode='nearest')[:8])
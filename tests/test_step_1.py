@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from step_1 import hysteresis_filter, hysteresis_filter_loop
+
+
+@pytest.mark.parametrize('n, n_false', [(5, None), (50, 1), (1, 3), (3, 7)])
+def test_hysteresis_filter_matches_loop(n, n_false):
+    rng = np.random.RandomState(n)
+    for flip_prob in [0.02, 0.2, 0.6]:
+        seq = np.logical_xor.accumulate(rng.rand(2000) < flip_prob)
+        assert np.array_equal(hysteresis_filter(seq, n, n_false),
+                              hysteresis_filter_loop(seq, n, n_false))
+
+
+def test_hysteresis_filter_short_sequences():
+    assert len(hysteresis_filter([])) == 0
+    for seq in [[True], [False], [False, True, True], [True] * 6 + [False] * 5]:
+        seq = np.array(seq)
+        assert np.array_equal(hysteresis_filter(seq), hysteresis_filter_loop(seq))
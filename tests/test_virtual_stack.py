@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import tifffile
+from virtual_stack import virtual_stack, open_mmstack
+
+
+def write_recording(tmp_path, compression=None):
+    """
+    A recording of 25 frames split over a first file and a continuation
+    file, named like Micro-Manager does.
+    """
+    frames = np.random.RandomState(0).randint(0, 65535, (25, 12, 20)).astype(np.uint16)
+    paths = [str(tmp_path / 'e_MMStack_Pos0.ome.tif'), str(tmp_path / 'e_MMStack_Pos0_1.ome.tif')]
+    for path, part in zip(paths, [frames[:16], frames[16:]]):
+        with tifffile.TiffWriter(path) as tif:
+            for frame in part:
+                tif.write(frame, compression=compression, contiguous=False)
+    return paths, frames
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_virtual_stack_matches_frames(tmp_path, compression):
+    paths, frames = write_recording(tmp_path, compression)
+    stack = virtual_stack(paths)
+    assert len(stack) == 25 and stack.shape == frames.shape and stack.dtype == frames.dtype
+    for key in [0, 15, 16, -1, slice(None), slice(3, 9), slice(10, 20), slice(14, 30, 3),
+                slice(20, 5)]:
+        assert np.array_equal(stack[key], frames[key])
+    assert np.array_equal(stack[10:20, 2:5, ::2], frames[10:20, 2:5, ::2])
+    chunks = list(stack.iter_chunks(7, 3, 24))
+    assert [start for start, chunk in chunks] == [3, 10, 17]
+    assert np.array_equal(np.concatenate([chunk for start, chunk in chunks]), frames[3:24])
+    assert np.array_equal(np.stack(list(stack)), frames)
+    with pytest.raises(IndexError):
+        stack[25]
+    stack.close()
+
+
+def test_open_mmstack_appends_continuation_files(tmp_path):
+    paths, frames = write_recording(tmp_path)
+    stack = open_mmstack(paths[0], min_frames=20)
+    assert stack.paths == paths
+    assert np.array_equal(stack[:], frames)
+    stack.close()
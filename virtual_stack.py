@@ -0,0 +1,242 @@
+import os.path
+import numpy as np
+try:
+    import tifffile
+except ImportError:
+    from skimage.external import tifffile
+
+
+class virtual_stack(object):
+    """
+    Lazy, read-only frame stack spanning several multi-page tif files.
+
+    Uncompressed pages are memory-mapped, so indexing a frame or a range of
+    frames that lies within one file returns a view into the file without
+    reading or copying the remaining data. Ranges that cross a file boundary
+    are concatenated, which only copies the requested frames.
+    """
+
+    def __init__(self, paths):
+        """
+        Initialize stack.
+
+        Parameters
+        ----------
+        paths : list of strings
+            Paths to the tif files in frame order.
+        """
+        self.paths = []
+        self._files = []
+        self._runs = []
+        self._run_starts = []
+        self.n_frames = 0
+        self.frame_shape = None
+        self.dtype = None
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        """
+        Append the frames of another tif file to the end of the stack.
+
+        Parameters
+        ----------
+        path : string
+            Path to tif file.
+        """
+        path = os.path.expanduser(os.path.expandvars(path))
+        for run in self._load_runs(path):
+            self._run_starts.append(self.n_frames)
+            self._runs.append(run)
+            self.n_frames += len(run)
+        if self.frame_shape is None:
+            self.frame_shape = tuple(self._runs[0].shape[1:])
+            self.dtype = self._runs[0].dtype
+        self.paths.append(path)
+
+    def _load_runs(self, path):
+        """
+        Group the pages of one tif file into runs of equally spaced pages.
+        Each run of contiguous pages is exposed as a single strided view on
+        a memory map of the file. Pages that are not stored contiguously
+        (e.g. compressed) are read on demand.
+        """
+        tif = tifffile.TiffFile(path)
+        dtype = np.dtype(tif.pages[0].dtype).newbyteorder(tif.byteorder)
+        offsets = []
+        for page in tif.pages:
+            offsets.append(_page_offset(page))
+        shape = tuple(tif.pages[0].shape)
+
+        if any(offset is None for offset in offsets):
+            self._files.append(tif)
+            return [_page_run(tif.pages, shape, dtype)]
+        tif.close()
+
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        frame_strides = (shape[1] * dtype.itemsize, dtype.itemsize)
+        runs = []
+        begin = 0
+        for i in range(1, len(offsets) + 1):
+            end_of_run = (i == len(offsets) or
+                          (i - begin > 1 and
+                           offsets[i] - offsets[i - 1] != offsets[begin + 1] - offsets[begin]))
+            if not end_of_run:
+                continue
+            stride = offsets[begin + 1] - offsets[begin] if i - begin > 1 else 0
+            runs.append(np.ndarray(shape=(i - begin,) + shape, dtype=dtype,
+                                   buffer=data, offset=offsets[begin],
+                                   strides=(stride,) + frame_strides))
+            begin = i
+        return runs
+
+    def __len__(self):
+        return self.n_frames
+
+    @property
+    def shape(self):
+        return (self.n_frames,) + tuple(self.frame_shape)
+
+    def _range(self, start, stop):
+        """
+        Return frames start to stop as one array. The result is a view
+        whenever the range lies within one run.
+        """
+        pieces = []
+        run_id = np.searchsorted(self._run_starts, start, side='right') - 1
+        while start < stop:
+            run_start = self._run_starts[run_id]
+            run = self._runs[run_id]
+            run_stop = min(stop, run_start + len(run))
+            pieces.append(run[start - run_start:run_stop - run_start])
+            start = run_stop
+            run_id += 1
+        if len(pieces) == 0:
+            return np.zeros((0,) + tuple(self.frame_shape), dtype=self.dtype)
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces, axis=0)
+
+    def __getitem__(self, key):
+        """
+        Index frames like a (frames, rows, columns) array. Only the frame
+        range that is requested is touched.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, rest = key[0], key[1:]
+        if isinstance(frame_key, slice):
+            start, stop, step = frame_key.indices(self.n_frames)
+            if step < 0:
+                frames = self._range(stop + 1, start + 1)[::step]
+            else:
+                frames = self._range(start, max(start, stop))[::step]
+            return frames[(slice(None),) + rest]
+        i = int(frame_key)
+        if i < 0:
+            i += self.n_frames
+        if not 0 <= i < self.n_frames:
+            raise IndexError('frame index out of range')
+        return self._range(i, i + 1)[0][rest]
+
+    def __iter__(self):
+        for start, chunk in self.iter_chunks():
+            for frame in chunk:
+                yield frame
+
+    def iter_chunks(self, chunk_size=200, start=0, stop=None):
+        """
+        Iterate over the stack in blocks of frames.
+
+        Parameters
+        ----------
+        chunk_size : int, default=200
+            Maximal number of frames per chunk.
+        start : int, default=0
+            First frame.
+        stop : int, optional, default=None
+            Frame after the last frame. If None, the end of the stack.
+
+        Yields
+        ------
+        start : int
+            Index of the first frame in the chunk.
+        chunk : 3D np.array
+            Frames with shape (n, rows, columns).
+        """
+        if stop is None:
+            stop = self.n_frames
+        for i in range(start, stop, chunk_size):
+            yield i, self._range(i, min(i + chunk_size, stop))
+
+    def close(self):
+        for tif in self._files:
+            tif.close()
+        self._files = []
+        self._runs = []
+        self._run_starts = []
+
+
+class _page_run(object):
+    """
+    Fallback run for pages that can not be memory-mapped.
+    """
+
+    def __init__(self, pages, shape, dtype):
+        self.pages = pages
+        self.shape = (len(pages),) + shape
+        self.dtype = dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            indices = range(*key.indices(len(self)))
+            return np.stack([self.pages[i].asarray() for i in indices]) \
+                if len(indices) else np.zeros((0,) + self.shape[1:], self.dtype)
+        return self.pages[key].asarray()
+
+
+def _page_offset(page):
+    """
+    Return the file offset of the image data of a page, or None if the
+    data is not stored as one contiguous uncompressed block.
+    """
+    offsets = getattr(page, 'dataoffsets', None)
+    if offsets is None:
+        # older tifffile versions return (offset, bytecount) or None
+        contiguous = page.is_contiguous
+        return contiguous[0] if contiguous else None
+    if not page.is_contiguous or getattr(page, 'compression', 1) != 1:
+        return None
+    return offsets[0]
+
+
+def open_mmstack(path, min_frames=18000):
+    """
+    Open a Micro-Manager OME-TIF recording as a virtual stack.
+    Continuation files (_1.ome.tif, _2.ome.tif, ...) are appended
+    until the stack holds at least min_frames frames.
+
+    Parameters
+    ----------
+    path : string
+        Path to the first file of the recording, ending in .ome.tif.
+    min_frames : int, default=18000
+        Number of frames expected in the recording.
+
+    Returns
+    -------
+    virtual_stack
+        Stack with all frames of the recording.
+    """
+    path = os.path.expanduser(os.path.expandvars(path))
+    stack = virtual_stack([path])
+    # if files were renamed it fails to automatically load all files
+    i = 1
+    while len(stack) < min_frames and i <= 4:
+        stack.append(path[:-8] + f'_{i}.ome.tif')
+        i += 1
+    assert len(stack) >= min_frames
+    return stack